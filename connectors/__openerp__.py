@@ -25,12 +25,15 @@
     'category': 'Generic Modules',
     'description': """
 Experiments around the connectors, with chocolate.
+
+Requires PostgreSQL 9.5 or a later version.
     """,
     'author': 'Camptocamp',
     'website': 'http://www.camptocamp.com',
     'depends': ['delivery'],
     'data': [
         'abstract/jobs_view.xml',
+        'abstract/jobs_data.xml',
         'implementation/external_referential_view.xml',
         'implementation/data.xml',
     ],
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Author: Guewen Baconnier
+#    Copyright 2012 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Channels of jobs
+
+Each job is executed in a channel, by default the ``root`` channel.
+A channel limits the number of its jobs running at the same time
+(capacity) and the number of its jobs started per second (rate limit),
+so a flood of jobs in a channel cannot starve the other channels or
+hammer an external system.
+
+The channels are configured with the ``connectors_channels`` option of
+the server configuration file, as a comma separated list of
+``name:capacity[:rate_limit]``, for instance::
+
+    connectors_channels = root:4,export:2:0.5
+
+or in the code with ``CHANNELS.configure_channel``. The limits stored in
+the database are applied by loaders registered with
+``CHANNELS.register_loader``, called periodically by the workers of each
+process so all the processes apply the same limits.
+
+The number of jobs of a channel kept in the memory of a queue can be
+bounded with the ``connectors_watermarks`` option, a comma separated
+list of ``name:high[:low]``, the name ``*`` applying to all the other
+channels::
+
+    connectors_watermarks = *:20000,export:5000:1000
+
+Above the high watermark, the new jobs of the channel are only stored,
+they are loaded from the storage when the channel goes below the low
+watermark (by default the half of the high watermark).
+
+The watermarks also apply to the queued jobs of the channel in the
+storage: once they reach the high watermark, the producers of jobs wait
+until they go below the low watermark, for a bounded time (see
+`JobsQueue`).
+
+"""
+
+import time
+
+import openerp
+
+DEFAULT_CHANNEL = 'root'
+
+
+class Channel(object):
+    """ Limits of a channel and its jobs being executed
+
+    :param name: name of the channel
+    :param capacity: maximum number of jobs running at the same time,
+                     unlimited when None
+    :param rate_limit: maximum number of jobs started per second,
+                       unlimited when None
+    """
+
+    def __init__(self, name, capacity=None, rate_limit=None):
+        self.name = name
+        self.running = 0
+        self.configure(capacity=capacity, rate_limit=rate_limit)
+        self.set_watermarks(None)
+
+    def configure(self, capacity=None, rate_limit=None):
+        self.capacity = capacity or None
+        self.rate_limit = rate_limit or None
+        # token bucket allowing bursts of up to 1 second of jobs
+        self._tokens = self._burst
+        self._last_refill = time.time()
+
+    def set_watermarks(self, high, low=None):
+        """ Bound the number of jobs of the channel kept in a queue
+
+        :param high: number of jobs above which the new jobs are
+                     deferred, unlimited when None
+        :param low: number of jobs below which the deferred jobs are
+                    admitted again, by default the half of `high`
+        """
+        self.high_watermark = high or None
+        if self.high_watermark is None:
+            self.low_watermark = None
+        elif low is None:
+            self.low_watermark = self.high_watermark // 2
+        else:
+            self.low_watermark = min(low, self.high_watermark)
+
+    def is_congested(self, depth):
+        """ Return True when `depth` jobs reach the high watermark """
+        return (self.high_watermark is not None and
+                depth >= self.high_watermark)
+
+    def can_admit(self, depth):
+        """ Return True when `depth` jobs are below the low watermark """
+        return self.low_watermark is None or depth < self.low_watermark
+
+    @property
+    def _burst(self):
+        if self.rate_limit is None:
+            return None
+        return max(1., self.rate_limit)
+
+    def _refill(self, now):
+        if self.rate_limit is None:
+            return
+        elapsed = now - self._last_refill
+        self._tokens = min(self._burst,
+                           self._tokens + elapsed * self.rate_limit)
+        self._last_refill = now
+
+    def is_full(self, running=None):
+        """ Return True when the channel runs as many jobs as it can
+
+        :param running: number of running jobs, by default the ones
+                        counted by the channel
+        """
+        if running is None:
+            running = self.running
+        return self.capacity is not None and running >= self.capacity
+
+    def wait_time(self, now=None):
+        """ Seconds to wait before the rate limit allows a new job """
+        if self.rate_limit is None:
+            return 0
+        if now is None:
+            now = time.time()
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate_limit
+
+    def quota(self, running=None, now=None):
+        """ Number of jobs the channel can start now, within its
+        capacity and its rate limit, None when unlimited
+
+        :param running: number of running jobs, by default the ones
+                        counted by the channel
+        """
+        if running is None:
+            running = self.running
+        quota = None
+        if self.capacity is not None:
+            quota = max(0, self.capacity - running)
+        if self.rate_limit is not None:
+            if now is None:
+                now = time.time()
+            self._refill(now)
+            tokens = max(0, int(self._tokens))
+            quota = tokens if quota is None else min(quota, tokens)
+        return quota
+
+    def available(self, now=None):
+        return not self.is_full() and not self.wait_time(now)
+
+    def take_token(self, now=None):
+        """ Count a job started for the rate limit """
+        if self.rate_limit is None:
+            return
+        if now is None:
+            now = time.time()
+        self._refill(now)
+        self._tokens -= 1
+
+    def job_started(self, now=None):
+        self.running += 1
+        self.take_token(now)
+
+    def job_done(self):
+        self.running = max(0, self.running - 1)
+
+    def __repr__(self):
+        return '<Channel %s>' % self.name
+
+
+class ChannelRegistry(object):
+
+    def __init__(self):
+        self.channels = {}
+        # (high, low) watermarks of the channels configured without
+        self.default_watermarks = (None, None)
+        self._own_watermarks = set()
+        self.loaders = []
+
+    def get_channel(self, name):
+        """ Return the channel, created without limits if unknown """
+        if name is None:
+            name = DEFAULT_CHANNEL
+        channel = self.channels.get(name)
+        if channel is None:
+            channel = self.channels[name] = Channel(name)
+            channel.set_watermarks(*self.default_watermarks)
+        return channel
+
+    def configure_channel(self, name, capacity=None, rate_limit=None):
+        channel = self.get_channel(name)
+        if (channel.capacity, channel.rate_limit) != (capacity or None,
+                                                      rate_limit or None):
+            channel.configure(capacity=capacity, rate_limit=rate_limit)
+        return channel
+
+    def register_loader(self, loader):
+        """ Register a function configuring channels from the
+        database, it receives a `Session` """
+        self.loaders.append(loader)
+
+    def load(self, session):
+        """ Configure the channels with the registered loaders """
+        for loader in self.loaders:
+            loader(session)
+
+    def configure_from_string(self, config):
+        """ Configure channels from a string of comma separated
+        ``name:capacity[:rate_limit]`` """
+        for item in config.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            parts = item.split(':')
+            if not 2 <= len(parts) <= 3:
+                raise ValueError('Invalid channel configuration: %s' % item)
+            capacity = int(parts[1]) if parts[1] else None
+            rate_limit = None
+            if len(parts) == 3 and parts[2]:
+                rate_limit = float(parts[2])
+            self.configure_channel(parts[0], capacity=capacity,
+                                   rate_limit=rate_limit)
+
+    def configure_watermarks(self, name, high, low=None):
+        """ Set the watermarks of a channel, or the default ones when
+        `name` is ``*`` """
+        if name == '*':
+            self.default_watermarks = (high, low)
+            for channel_name, channel in self.channels.iteritems():
+                if channel_name not in self._own_watermarks:
+                    channel.set_watermarks(high, low)
+            return
+        self._own_watermarks.add(name)
+        self.get_channel(name).set_watermarks(high, low)
+
+    def configure_watermarks_from_string(self, config):
+        """ Configure watermarks from a string of comma separated
+        ``name:high[:low]`` """
+        for item in config.split(','):
+            item = item.strip()
+            if not item:
+                continue
+            parts = item.split(':')
+            if not 2 <= len(parts) <= 3:
+                raise ValueError('Invalid watermarks configuration: %s' %
+                                 item)
+            low = None
+            if len(parts) == 3 and parts[2]:
+                low = int(parts[2])
+            self.configure_watermarks(parts[0], int(parts[1]), low=low)
+
+
+CHANNELS = ChannelRegistry()
+CHANNELS.configure_from_string(
+        openerp.tools.config.get('connectors_channels') or '')
+CHANNELS.configure_watermarks_from_string(
+        openerp.tools.config.get('connectors_watermarks') or '')
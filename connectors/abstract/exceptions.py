@@ -40,6 +40,10 @@ class NotReadableJobError(JobError):
     """ The job cannot be read from the storage. """
 
 
+class NoSuchTaskError(JobError):
+    """ The function of a job is not a registered task. """
+
+
 class FailedJobError(JobError):
     """ A job had an error having to be resolved. """
 
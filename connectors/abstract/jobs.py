@@ -22,32 +22,196 @@
 ##############################################################################
 
 import logging
-import importlib
 import inspect
+import random
 from uuid import uuid4
-from cPickle import loads, dumps, UnpicklingError # XXX check errors
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from psycopg2 import Binary
 
 from openerp import SUPERUSER_ID
 from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
-from .exceptions import NoSuchJobError, NotReadableJobError
+from .serializers import SERIALIZERS, LazyPayload
+from .channels import DEFAULT_CHANNEL
+from .exceptions import NoSuchJobError, NotReadableJobError, NoSuchTaskError
 
 QUEUED = 'queued'
 DONE = 'done'
 STARTED = 'started'
 FAILED = 'failed'
+WAITING = 'waiting'  # the jobs it depends on are not done
+
+# states a job must have to go to a state
+PREVIOUS_STATES = {
+    STARTED: (QUEUED,),
+    DONE: (STARTED,),
+    FAILED: (QUEUED, STARTED),
+}
 
 DEFAULT_PRIORITY = 10  # used by the PriorityQueue to sort the jobs
+DEFAULT_MAX_RETRIES = 5
+RETRY_BASE_DELAY = 10  # seconds, doubled at each retry
+RETRY_MAX_DELAY = 3600  # seconds
+INSERT_BATCH_SIZE = 1000  # max. number of jobs inserted in one statement
+LOAD_BATCH_SIZE = 1000  # number of pending jobs read in one statement
+RELAY_BATCH_SIZE = 1000  # number of outbox rows taken in one statement
 
 
 _logger = logging.getLogger(__name__)
 
 
+def _parse_datetime(value):
+    """ The cursors return the timestamps as strings """
+    if not value or isinstance(value, datetime):
+        return value or None
+    return datetime.strptime(value[:19], DEFAULT_SERVER_DATETIME_FORMAT)
+
+
+class TaskRegistry(object):
+    """ Registry of the functions which can be executed in jobs,
+    filled by the ``@task`` decorator """
+
+    def __init__(self):
+        self.tasks = {}
+
+    def register_task(self, task):
+        self.tasks[task.name] = task
+
+    def get_task(self, name):
+        try:
+            return self.tasks[name]
+        except KeyError:
+            raise NoSuchTaskError('%s is not a registered task, the function '
+                                  'should be decorated by @task' % name)
+
+
+TASKS = TaskRegistry()
+
+
+class Task(object):
+    """ A function which can be executed in jobs, with its options
+
+    :param func: the function
+    :param priority: default priority of the jobs
+    :param max_retries: default maximum number of retries of the jobs
+    :param coalesce_key: function receiving the arguments of a job as a
+                         dict and returning a key, a new job is merged
+                         in a queued job of the task having the same key
+    :param coalesce: function receiving the arguments of the queued job
+                     and of the new job as dicts and returning the merged
+                     arguments, by default the queued job is kept as is
+    :param debounce: number of seconds a new job waits before being
+                     executed, giving time to coalesce the next ones
+    :param channel: name of the channel of the jobs, or function
+                    receiving the arguments of a job as a dict and
+                    returning the name of its channel
+    :param timeout: maximum number of seconds of execution of the jobs
+    :param profile: if True, the execution of the jobs is profiled
+    :param batch_size: maximum number of jobs of the task executed by a
+                       worker in one transaction, only for the functions
+                       which never commit
+    """
+
+    def __init__(self, func, priority=None, max_retries=None,
+                 coalesce_key=None, coalesce=None, debounce=None,
+                 channel=None, timeout=None, profile=False,
+                 batch_size=None):
+        self.func = func
+        self.name = '%s.%s' % (func.__module__, func.__name__)
+        self.priority = priority
+        self.max_retries = max_retries
+        self.coalesce_key = coalesce_key
+        self.coalesce = coalesce
+        self.debounce = debounce
+        self.channel = channel
+        self.timeout = timeout
+        self.profile = profile
+        self.batch_size = batch_size
+
+    def call_args(self, args, kwargs):
+        """ Return the arguments of a call as a dict """
+        call_args = inspect.getcallargs(self.func, None, *args, **kwargs)
+        del call_args[inspect.getargspec(self.func).args[0]]  # session
+        return call_args
+
+    def __repr__(self):
+        return '<Task %s>' % self.name
+
+
 class JobStorage(object):
 
     def store(self):
         """ Store a job """
 
+    @classmethod
+    def store_many(cls, session, jobs):
+        """ Store many new jobs at once """
+        for job in jobs:
+            cls(job, session).store()
+
+    @classmethod
+    def pending_jobs(cls, session, job_cls):
+        """ Yield batches of the queued jobs, with only the data needed
+        to put them in a queue """
+        return iter(())
+
+    @classmethod
+    def queued_jobs(cls, session, job_cls, channel, limit):
+        """ Return the first `limit` queued jobs of a channel, with only
+        the data needed to put them in a queue """
+        return []
+
+    @classmethod
+    def count_queued(cls, session, channel, limit=None):
+        """ Number of queued jobs of a channel, up to `limit` """
+        return 0
+
+    @classmethod
+    def release_waiting(cls, session, job_cls, parent=None, uuids=None,
+                        policy=None):
+        """ Set as queued the waiting jobs whose parents are all done,
+        returns them """
+        return []
+
+    @classmethod
+    def requeue_orphans(cls, session, job_cls):
+        """ Set as queued the started jobs whose worker is gone,
+        returns them """
+        return []
+
+    @classmethod
+    def add_to_outbox(cls, session, jobs):
+        """ Record stored jobs to put in the queue once the transaction
+        of the session is committed """
+
+    @classmethod
+    def pop_outbox(cls, session, job_cls, batch_size=None):
+        """ Remove committed jobs from the outbox and return them """
+        return []
+
+    def update_state(self, from_states, commit=True):
+        """ Write the state of the job if the stored job has one of the
+        `from_states`, returns True if it has been written """
+        return False
+
+    @classmethod
+    def start_many(cls, session, jobs, from_states):
+        """ Set jobs as started and commit, only the ones having one of
+        the `from_states`, returns the jobs which have been started """
+        started = []
+        for job in jobs:
+            job.state = STARTED
+            job.date_started = datetime.now()
+            if cls(job, session).update_state(from_states, commit=False):
+                started.append(job)
+        session.commit()
+        return started
+
+    def coalesce(self, merge):
+        """ Merge the job in a queued job having the same coalesce key,
+        returns True if it has been merged """
+        return False
+
     def refresh(self):
         """ Read the job's data from the storage """
 
@@ -64,7 +228,6 @@ class OpenERPJobStorage(JobStorage):
         super(OpenERPJobStorage, self).__init__()
         self.session = session
         self.job = job
-        self._openerp_id = None
         self.storage_model = self.session.pool.get(self._storage_model_name)
         assert self.storage_model is not None, ("Model %s not found" %
                                                 self._storage_model_name)
@@ -73,16 +236,26 @@ class OpenERPJobStorage(JobStorage):
         """Returns if a job still exists in the storage."""
         return bool(self.openerp_id)
 
-    def store(self):
-        """ Store the Job """
+    # columns written by `store_many`
+    _insert_columns = ('uuid', 'state', 'name', 'func_string', 'func',
+                       'priority', 'retry', 'max_retries', 'date_created',
+                       'date_enqueued', 'only_after', 'user_id',
+                       'coalesce_key', 'channel', 'func_name',
+                       'latest_start')
+
+    def _job_values(self):
+        """ Values of the job to write in the storage """
         vals = dict(uuid=self.job.id,
                     state=self.job.state,
                     name=self.job.name,
-                    func_string=self.job.func_string)
+                    func_string=self.job.func_string,
+                    priority=self.job.priority,
+                    retry=self.job.retry,
+                    max_retries=self.job.max_retries)
 
-        vals['func'] = dumps((self.job.func_name,
-                              self.job.args,
-                              self.job.kwargs))
+        vals['func'] = SERIALIZERS.dumps((self.job.func_name,
+                                          self.job.args,
+                                          self.job.kwargs))
 
         if self.job.date_created:
             vals['date_created'] = self.job.date_created.strftime(
@@ -99,15 +272,25 @@ class OpenERPJobStorage(JobStorage):
         if self.job.only_after:
             vals['only_after'] = self.job.only_after.strftime(
                     DEFAULT_SERVER_DATETIME_FORMAT)
+        if self.job.latest_start:
+            vals['latest_start'] = self.job.latest_start.strftime(
+                    DEFAULT_SERVER_DATETIME_FORMAT)
 
         if self.job.exc_info is not None:
             vals['exc_info'] = self.job.exc_info
 
-        if self.job.result is not None:
-            vals['result'] = dumps(self.job.result)
+        if self.job.result_payload is not None:
+            vals['result'] = self.job.result_payload
 
         vals['user_id'] = self.job.user_id
+        vals['coalesce_key'] = self.job.coalesce_key
+        vals['channel'] = self.job.channel
+        vals['func_name'] = self.job.func_name
+        return vals
 
+    def store(self):
+        """ Store the Job, in the transaction of the session """
+        vals = self._job_values()
         if self.openerp_id:
             self.storage_model.write(
                     self.session.cr,
@@ -116,16 +299,343 @@ class OpenERPJobStorage(JobStorage):
                     vals,
                     self.session.context)
         else:
-            self.storage_model.create(
+            self.job.storage_id = self.storage_model.create(
                     self.session.cr,
                     self.session.uid,
                     vals,
                     self.session.context)
-        self.session.commit()
+            self._store_dependencies(
+                    self.session,
+                    [(self.job.id, parent) for parent in self.job.depends_on])
+
+    @classmethod
+    def store_many(cls, session, jobs):
+        """ Store many new jobs with one multi-rows INSERT, in the
+        transaction of the session """
+        rows = []
+        for job in jobs:
+            vals = cls(job, session)._job_values()
+            vals['func'] = Binary(vals['func'])
+            rows.append(tuple(vals.get(column) for column
+                              in cls._insert_columns))
+        storage_ids = {}
+        dependencies = []
+        for job in jobs:
+            dependencies += [(job.id, parent) for parent in job.depends_on]
+        for index in xrange(0, len(rows), INSERT_BATCH_SIZE):
+            batch = rows[index:index + INSERT_BATCH_SIZE]
+            session.cr.execute(
+                "INSERT INTO jobs_storage (%s) VALUES %s "
+                "RETURNING uuid, id" %
+                (', '.join(cls._insert_columns),
+                 ', '.join(['%s'] * len(batch))),
+                batch)
+            storage_ids.update(session.cr.fetchall())
+        for job in jobs:
+            job.storage_id = storage_ids[job.id]
+        cls._store_dependencies(session, dependencies)
+
+    @classmethod
+    def _store_dependencies(cls, session, dependencies):
+        """ Insert the ``(job uuid, parent uuid)`` of the jobs waiting
+        for other jobs
+
+        The parents are locked until the end of the transaction: a
+        parent cannot be done before the dependencies are committed,
+        so either its worker sees them when it releases its children,
+        or the parent is already done when the transaction checks it.
+        """
+        if not dependencies:
+            return
+        parents = sorted(set(parent for __, parent in dependencies))
+        session.cr.execute("SELECT id FROM jobs_storage "
+                           "WHERE uuid IN %s "
+                           "ORDER BY id FOR SHARE",
+                           (tuple(parents),))
+        for index in xrange(0, len(dependencies), INSERT_BATCH_SIZE):
+            batch = dependencies[index:index + INSERT_BATCH_SIZE]
+            session.cr.execute(
+                "INSERT INTO jobs_storage_dependency "
+                "(job_uuid, parent_uuid) VALUES %s" %
+                ', '.join(['%s'] * len(batch)),
+                batch)
+
+    @classmethod
+    def _compact_job(cls, job_cls, row):
+        """ Job with only the data needed to put it in a queue, from a
+        row ``(id, uuid, priority, channel, date_enqueued, only_after,
+        func_name)``
+        """
+        (storage_id, uuid, priority, channel,
+         date_enqueued, only_after, func_name) = row
+        job = job_cls(job_id=uuid, priority=priority,
+                      only_after=_parse_datetime(only_after),
+                      storage_cls=cls)
+        job.storage_id = storage_id
+        job.state = QUEUED
+        job.channel = channel or DEFAULT_CHANNEL
+        job.date_enqueued = _parse_datetime(date_enqueued)
+        job.func_name = func_name
+        return job
+
+    @classmethod
+    def pending_jobs(cls, session, job_cls, batch_size=LOAD_BATCH_SIZE):
+        """ Yield batches of the queued jobs, with only the data needed
+        to put them in a queue
+
+        Each batch is read with one query, without reading the
+        payloads, they are read when the jobs are executed.
+        """
+        last_id = 0
+        while True:
+            session.cr.execute(
+                "SELECT id, uuid, priority, channel, date_enqueued, "
+                "       only_after, func_name "
+                "FROM jobs_storage "
+                "WHERE state = %s AND id > %s "
+                "ORDER BY id LIMIT %s",
+                (QUEUED, last_id, batch_size))
+            rows = session.cr.fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [cls._compact_job(job_cls, row) for row in rows]
+
+    @classmethod
+    def queued_jobs(cls, session, job_cls, channel, limit):
+        """ Return the first `limit` queued jobs of a channel, ordered
+        by their latest start date, with only the data needed to put
+        them in a queue """
+        session.cr.execute(
+            "SELECT j.id, j.uuid, j.priority, j.channel, j.date_enqueued, "
+            "       j.only_after, j.func_name "
+            "FROM jobs_storage j "
+            "WHERE j.state = %s AND COALESCE(j.channel, %s) = %s "
+            "ORDER BY j.latest_start, j.id "
+            "LIMIT %s",
+            (QUEUED, DEFAULT_CHANNEL, channel, limit))
+        return [cls._compact_job(job_cls, row)
+                for row in session.cr.fetchall()]
+
+    @classmethod
+    def count_queued(cls, session, channel, limit=None):
+        """ Number of queued jobs of a channel, counted up to `limit`
+        to bound the cost of the count """
+        session.cr.execute(
+            "SELECT count(*) FROM (SELECT 1 FROM jobs_storage "
+            "                      WHERE state = %s AND channel = %s "
+            "                      LIMIT %s) AS queued",
+            (QUEUED, channel, limit))
+        return session.cr.fetchone()[0]
+
+    @classmethod
+    def release_waiting(cls, session, job_cls, parent=None, uuids=None,
+                        policy=None):
+        """ Set as queued the waiting jobs whose parents are all done
+
+        A parent no longer in the storage has been done and removed.
+        The jobs are changed in one statement so the last parent done
+        releases its children once, even if the parents are done
+        concurrently.
+
+        :param parent: release only the children of this job uuid
+        :param uuids: release only these jobs
+        :param policy: `AgingPolicy` computing the latest start date of
+                       the released jobs
+        :return: the released jobs, with only the data needed to put
+                 them in a queue
+        """
+        now = datetime.now().strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        assignments = "state = %s, date_enqueued = %s"
+        params = [QUEUED, now]
+        if policy is not None:
+            latest_start, latest_params = policy.sql_latest_start(
+                    'j', date_enqueued=now)
+            assignments += ", latest_start = " + latest_start
+            params += latest_params
+        params.append(WAITING)
+        where = ""
+        if parent is not None:
+            where += ("AND j.uuid IN (SELECT job_uuid "
+                      "               FROM jobs_storage_dependency "
+                      "               WHERE parent_uuid = %s) ")
+            params.append(parent)
+        if uuids is not None:
+            where += "AND j.uuid IN %s "
+            params.append(tuple(uuids))
+        params.append(DONE)
+        session.cr.execute(
+            "UPDATE jobs_storage j SET " + assignments + " "
+            "WHERE j.state = %s " + where +
+            "AND NOT EXISTS (SELECT 1 FROM jobs_storage_dependency d "
+            "                JOIN jobs_storage p "
+            "                ON p.uuid = d.parent_uuid "
+            "                WHERE d.job_uuid = j.uuid "
+            "                AND p.state != %s) "
+            "RETURNING j.id, j.uuid, j.priority, j.channel, "
+            "          j.date_enqueued, j.only_after, j.func_name",
+            params)
+        return [cls._compact_job(job_cls, row)
+                for row in session.cr.fetchall()]
+
+    @classmethod
+    def requeue_orphans(cls, session, job_cls):
+        """ Set as queued the started jobs whose worker is gone
+
+        A started job records the PID of the database backend of its
+        worker. When this backend no longer exists, the process of the
+        worker has been stopped or has lost its connection and the job
+        will never finish.
+
+        :return: the queued jobs, with only the data needed to put them
+                 in a queue
+        """
+        session.cr.execute(
+            "UPDATE jobs_storage SET state = %s, worker_pid = NULL "
+            "WHERE state = %s "
+            "AND (worker_pid IS NULL OR "
+            "     worker_pid NOT IN (SELECT pid FROM pg_stat_activity)) "
+            "RETURNING id, uuid, priority, channel, date_enqueued, "
+            "          only_after, func_name",
+            (QUEUED, STARTED))
+        return [cls._compact_job(job_cls, row)
+                for row in session.cr.fetchall()]
+
+    @classmethod
+    def add_to_outbox(cls, session, jobs):
+        """ Record stored jobs to put in the queue once the transaction
+        of the session is committed, see `pop_outbox` """
+        session.cr.execute(
+            "INSERT INTO jobs_storage_outbox (job_id) VALUES %s" %
+            ', '.join(['(%s)'] * len(jobs)),
+            [job.storage_id for job in jobs])
+
+    @classmethod
+    def pop_outbox(cls, session, job_cls, batch_size=RELAY_BATCH_SIZE):
+        """ Remove jobs from the outbox and return them, with only the
+        data needed to put them in a queue
+
+        Only the jobs of committed transactions are visible. The rows
+        locked by another relay are skipped.
+
+        Must be called at the start of a transaction: it is switched to
+        READ COMMITTED, because in REPEATABLE READ the rows taken and
+        committed by another relay after the snapshot would raise a
+        serialization error instead of being skipped.
+        """
+        session.cr.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        session.cr.execute(
+            "WITH taken AS ("
+            "  DELETE FROM jobs_storage_outbox "
+            "  WHERE id IN (SELECT id FROM jobs_storage_outbox "
+            "               ORDER BY id LIMIT %s "
+            "               FOR UPDATE SKIP LOCKED) "
+            "  RETURNING job_id) "
+            "SELECT j.id, j.uuid, j.priority, j.channel, j.date_enqueued, "
+            "       j.only_after, j.func_name "
+            "FROM jobs_storage j JOIN taken t ON t.job_id = j.id "
+            "WHERE j.state = %s",
+            (batch_size, QUEUED))
+        return [cls._compact_job(job_cls, row)
+                for row in session.cr.fetchall()]
+
+    def update_state(self, from_states, commit=True):
+        """ Write the state of the job and the related values in one
+        statement, only if the stored job has one of the `from_states`
+
+        Returns True if the state has been written.
+        """
+        vals = {'state': self.job.state}
+        if self.job.state == STARTED and self.job.date_started:
+            vals['date_started'] = self.job.date_started.strftime(
+                    DEFAULT_SERVER_DATETIME_FORMAT)
+        if self.job.state == DONE and self.job.date_done:
+            vals['date_done'] = self.job.date_done.strftime(
+                    DEFAULT_SERVER_DATETIME_FORMAT)
+        if self.job.state == DONE and self.job.result_payload is not None:
+            vals['result'] = Binary(self.job.result_payload)
+        if self.job.exc_info is not None:
+            vals['exc_info'] = self.job.exc_info
+        if self.job.profile_stats is not None:
+            vals['profile_stats'] = self.job.profile_stats
+            vals['query_count'] = self.job.query_count
+        columns = sorted(vals)
+        assignments = ['%s = %%s' % column for column in columns]
+        if self.job.state == STARTED:
+            # owner of the job, see `requeue_orphans`
+            assignments.append('worker_pid = pg_backend_pid()')
+        self.session.cr.execute(
+            "UPDATE jobs_storage SET %s "
+            "WHERE uuid = %%s AND state IN %%s" % ', '.join(assignments),
+            [vals[column] for column in columns] +
+            [self.job.id, tuple(from_states)])
+        applied = self.session.cr.rowcount == 1
+        if commit:
+            self.session.commit()
+        return applied
+
+    @classmethod
+    def start_many(cls, session, jobs, from_states):
+        """ Set jobs as started in one statement and commit, only the
+        ones having one of the `from_states`
+
+        Returns the jobs which have been started.
+        """
+        now = datetime.now()
+        session.cr.execute(
+            "UPDATE jobs_storage SET state = %s, date_started = %s, "
+            "                        worker_pid = pg_backend_pid() "
+            "WHERE uuid IN %s AND state IN %s "
+            "RETURNING uuid",
+            (STARTED, now.strftime(DEFAULT_SERVER_DATETIME_FORMAT),
+             tuple(job.id for job in jobs), tuple(from_states)))
+        started = set(uuid for uuid, in session.cr.fetchall())
+        session.commit()
+        jobs = [job for job in jobs if job.id in started]
+        for job in jobs:
+            job.state = STARTED
+            job.date_started = now
+        return jobs
+
+    def coalesce(self, merge):
+        """ Merge the job in a queued job having the same coalesce key
+
+        The arguments of both jobs are merged with the `merge` function
+        in the queued job, the new job is not stored.
+        The queued job is locked so a worker cannot start it meanwhile.
+
+        Returns True if the job has been merged.
+        """
+        cr = self.session.cr
+        cr.execute("SELECT id, uuid, func FROM jobs_storage "
+                   "WHERE coalesce_key = %s AND state = %s "
+                   "ORDER BY id LIMIT 1 "
+                   "FOR UPDATE",
+                   (self.job.coalesce_key, QUEUED))
+        row = cr.fetchone()
+        if row is None:
+            return False
+        storage_id, uuid, payload = row
+        # the new job is now the queued one
+        self.job._id = uuid
+        self.job.storage_id = storage_id
+        pending = self.job.__class__(job_id=uuid)
+        pending.func_name, __, kwargs = SERIALIZERS.loads(payload)
+        pending.args = ()
+        pending.kwargs = merge(kwargs, self.job.kwargs)
+        cr.execute("UPDATE jobs_storage SET func = %s, func_string = %s "
+                   "WHERE id = %s",
+                   (Binary(SERIALIZERS.dumps((pending.func_name,
+                                              pending.args,
+                                              pending.kwargs))),
+                    pending.func_string,
+                    storage_id))
+        return True
 
     @property
     def openerp_id(self):
-        if self._openerp_id is None:
+        """ ID of the job in the storage, kept on the job once known """
+        if self.job.storage_id is None:
             job_ids = self.storage_model.search(
                     self.session.cr,
                     SUPERUSER_ID,
@@ -133,9 +643,9 @@ class OpenERPJobStorage(JobStorage):
                     context=self.session.context,
                     limit=1)
             if job_ids:
-                self._openerp_id = job_ids[0]
+                self.job.storage_id = job_ids[0]
 
-        return self._openerp_id
+        return self.job.storage_id
 
     def refresh(self):
         """ read again the metadata from the storage """
@@ -147,7 +657,7 @@ class OpenERPJobStorage(JobStorage):
                                            self.openerp_id,
                                            context=self.session.context)
 
-        func = loads(str(stored.func))
+        func = SERIALIZERS.loads(stored.func)
 
         (self.job.func_name,
          self.job.args,
@@ -174,7 +684,12 @@ class OpenERPJobStorage(JobStorage):
                     stored.only_after, DEFAULT_SERVER_DATETIME_FORMAT)
 
         self.job.state = stored.state
-        self.job.result = loads(str(stored.result)) if stored.result else None
+        self.job.priority = stored.priority
+        self.job.retry = stored.retry
+        self.job.max_retries = stored.max_retries
+        self.job.coalesce_key = stored.coalesce_key or None
+        self.job.channel = stored.channel or DEFAULT_CHANNEL
+        self.job.result = LazyPayload(stored.result) if stored.result else None
         self.job.exc_info = stored.exc_info if stored.exc_info else None
         self.job.user_id = stored.user_id
 
@@ -184,7 +699,8 @@ class Job(object):
 
     def __init__(self, job_id=None, func=None,
                  args=None, kwargs=None, priority=None,
-                 only_after=None, storage_cls=OpenERPJobStorage):
+                 only_after=None, max_retries=None,
+                 depends_on=None, storage_cls=OpenERPJobStorage):
         if args is None:
             args = ()
         assert isinstance(args, tuple), "%s: args are not a tuple" % args
@@ -197,6 +713,7 @@ class Job(object):
         self.state = None
 
         self.func_name = None
+        task = None
         if func:
             if inspect.ismethod(func):
                 raise NotImplementedError('Jobs on instances are not supported')
@@ -204,26 +721,67 @@ class Job(object):
                 self.func_name = '%s.%s' % (func.__module__, func.__name__)
             else:
                 raise TypeError('%s is not a valid function for a job' % func)
+            task = TASKS.get_task(self.func_name)
 
         self._id = job_id
 
         self.args = args
         self.kwargs = kwargs
 
+        # jobs having the same key are merged while they are queued
+        self.coalesce_key = None
+        if task is not None and task.coalesce_key is not None:
+            # the arguments are stored by names to be merged
+            self.kwargs = task.call_args(args, kwargs)
+            self.args = ()
+            self.coalesce_key = '%s%r' % (task.name,
+                                          task.coalesce_key(self.kwargs))
+
+        self.channel = DEFAULT_CHANNEL
+        if task is not None and task.channel is not None:
+            if callable(task.channel):
+                self.channel = task.channel(task.call_args(self.args,
+                                                           self.kwargs))
+            else:
+                self.channel = task.channel
+
+        if only_after is None and task is not None and task.debounce:
+            only_after = datetime.now() + timedelta(seconds=task.debounce)
         self.only_after = only_after
         self.priority = priority
+        if self.priority is None and task is not None:
+            self.priority = task.priority
         if self.priority is None:
             self.priority = DEFAULT_PRIORITY
 
+        self.retry = 0
+        self.max_retries = max_retries
+        if self.max_retries is None and task is not None:
+            self.max_retries = task.max_retries
+        if self.max_retries is None:
+            self.max_retries = DEFAULT_MAX_RETRIES
+
+        # uuids of the jobs which must be done before this one
+        self.depends_on = [parent.id if isinstance(parent, Job) else parent
+                           for parent in depends_on or ()]
+
         self.storage_cls = storage_cls
+        self._storage = None
+        # ID of the job in the storage, set by the storage
+        self.storage_id = None
 
         self.date_created = datetime.now()
         self.date_enqueued = None
+        # latest date the job should start, computed by the queue
+        self.latest_start = None
         self.date_started = None
         self.date_done = None
 
-        self.result = None
+        self._result = None
         self.exc_info = None
+        # summary of the profiling of the execution, see `Profiler`
+        self.profile_stats = None
+        self.query_count = None
 
         self.user_id = None
 
@@ -236,6 +794,27 @@ class Job(object):
             self.result = self.func(session, *self.args, **self.kwargs)
         return self.result
 
+    @property
+    def result(self):
+        """ Result of the job, a result read from the storage is decoded
+        on the first access """
+        if isinstance(self._result, LazyPayload):
+            self._result = self._result.value
+        return self._result
+
+    @result.setter
+    def result(self, value):
+        self._result = value
+
+    @property
+    def result_payload(self):
+        """ Result of the job encoded for the storage """
+        if self._result is None:
+            return None
+        if isinstance(self._result, LazyPayload):
+            return self._result.payload
+        return SERIALIZERS.dumps(self._result)
+
     @property
     def func_string(self):
         if self.func_name is None:
@@ -257,40 +836,99 @@ class Job(object):
             self._id = unicode(uuid4())
         return self._id
 
+    @property
+    def task(self):
+        if self.func_name is None:
+            return None
+        return TASKS.get_task(self.func_name)
+
+    @property
+    def timeout(self):
+        """ Maximum number of seconds of execution, declared on the task """
+        task = self.task
+        if task is None:
+            return None
+        return task.timeout
+
     @property
     def func(self):
-        func_name = self.func_name
-        if func_name is None:
+        task = self.task
+        if task is None:
             return None
+        return task.func
 
-        module_name, func_name = func_name.rsplit('.', 1)
-        module = importlib.import_module(module_name)
-        return getattr(module, func_name)
+    def coalesce(self, session):
+        """ Merge a new job in a queued job of the same task having the
+        same coalesce key
 
-    def store(self, *args, **kwargs):
+        Returns True if the job has been merged, it must not be stored
+        then.
+        """
+        if self.coalesce_key is None or self.depends_on:
+            return False
+        merge = self.task.coalesce
+        if merge is None:
+            merge = lambda pending, new: pending
+        storage = self._get_storage(session)
+        return storage.coalesce(merge)
+
+    def _get_storage(self, session):
+        """ Return the storage of the job, working with `session`
+
+        The same storage is used during the life of the job.
+        """
+        if self._storage is None:
+            self._storage = self.storage_cls(self, session)
+        else:
+            self._storage.session = session
+        return self._storage
+
+    def store(self, session):
         """ Store the Job """
-        storage = self.storage_cls(self, *args, **kwargs)
+        storage = self._get_storage(session)
         storage.store()
 
-    def refresh(self, *args, **kwargs):
+    def refresh(self, session):
         """ read again the metadata from the storage """
-        storage = self.storage_cls(self, *args, **kwargs)
+        storage = self._get_storage(session)
         try:
             storage.refresh()
         except NoSuchJobError:
             raise
         except Exception as err:
             raise NotReadableJobError(err)
+        # fail now rather than during the execution of the job
+        TASKS.get_task(self.func_name)
 
-    def exists(self, *args, **kwargs):
+    def exists(self, session):
         """ Check if a job still exists in the storage """
-        storage = self.storage_cls(self, *args, **kwargs)
+        storage = self._get_storage(session)
         return storage.exists()
 
-    def set_state(self, session, state, result=None, exc_info=None):
-        """Change the state of the job."""
-        if self.exists(session):
-            self.refresh(session)
+    def postpone(self):
+        """ Count a new try and delay the next execution of the job
+
+        The delay grows exponentially with the number of tries and a
+        random jitter spreads the retries of the jobs failing together.
+        """
+        self.retry += 1
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (self.retry - 1))
+        delay = random.uniform(delay / 2., delay)
+        self.only_after = datetime.now() + timedelta(seconds=delay)
+
+    def set_state(self, session, state, result=None, exc_info=None,
+                  from_states=None, commit=True):
+        """Change the state of the job.
+
+        The storage is modified in one statement and only if the job
+        still has one of the `from_states` (by default the states
+        allowed before `state`), so 2 workers cannot start the same job.
+        The change is committed unless `commit` is False.
+
+        Returns True if the state has been changed.
+        """
+        if from_states is None:
+            from_states = PREVIOUS_STATES[state]
 
         self.state = state
 
@@ -305,7 +943,9 @@ class Job(object):
         if exc_info is not None:
             self.exc_info = exc_info
 
-        self.store(session)
+        storage = self._get_storage(session)
+        return storage.update_state(from_states, commit=commit)
 
     def __repr__(self):
-        return '<Job %s, priority:%d>' % (self.id, self.priority)
+        return '<Job %s, priority:%d, channel:%s>' % (self.id, self.priority,
+                                                     self.channel)
@@ -19,11 +19,27 @@
 #
 ##############################################################################
 
+import logging
+import zlib
+from datetime import datetime, timedelta
+
+from psycopg2 import Binary
+
 from openerp.osv import orm, fields
+from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT, ustr
 
 from .queue import JobsQueue
 from .session import Session
-from .jobs import Job
+from .jobs import Job, WAITING, QUEUED, STARTED, DONE
+from .metrics import METRICS
+from .serializers import SERIALIZERS
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_RETENTION_DAYS = 30
+VACUUM_BATCH_SIZE = 1000
+# SKIP LOCKED and ON CONFLICT are used by the queues and the scheduler
+MIN_POSTGRESQL_VERSION = 90500
 
 
 class JobsStorageModel(orm.Model):
@@ -37,23 +53,222 @@ class JobsStorageModel(orm.Model):
         'uuid': fields.char('UUID', readonly=True, select=True),
         'name': fields.char('Description', readonly=True),
         'func_string': fields.char('Task', readonly=True),
-        'func': fields.text('Pickled Job Function', readonly=True),
+        'func': fields.binary('Serialized Job Function', readonly=True),
         # TODO: use the constants from module .tasks
-        'state': fields.selection([('queued', 'Queued'),
+        'state': fields.selection([('waiting', 'Waiting'),
+                                   ('queued', 'Queued'),
                                    ('started', 'Started'),
                                    ('failed', 'Failed'),
                                    ('done', 'Done')],
                                   string='State',
                                   readonly=True),
         'exc_info': fields.text('Traceback', readonly=True),
-        'result': fields.text('Result', readonly=True),
+        'result': fields.binary('Serialized Result', readonly=True),
         'date_created': fields.datetime('Created Date', readonly=True),
         'date_started': fields.datetime('Start Date', readonly=True),
         'date_enqueued': fields.datetime('Enqueue Time', readonly=True),
         'date_done': fields.datetime('Date Done', readonly=True),
         'only_after': fields.datetime('Execute only after'),
+        'priority': fields.integer('Priority', readonly=True),
+        'retry': fields.integer('Current try', readonly=True),
+        'max_retries': fields.integer('Max. retries', readonly=True),
+        'user_id': fields.many2one('res.users', 'User ID', readonly=True),
+        'coalesce_key': fields.char('Coalesce Key', readonly=True,
+                                    select=True),
+        'channel': fields.char('Channel', readonly=True),
+        'func_name': fields.char('Task Name', readonly=True),
+        'profile_stats': fields.text('Profiling', readonly=True),
+        'query_count': fields.integer('SQL Queries', readonly=True),
+        'latest_start': fields.datetime('Latest Start', readonly=True),
+        # database backend of the worker executing the job
+        'worker_pid': fields.integer('Worker PID', readonly=True),
         }
 
+    def _auto_init(self, cr, context=None):
+        cr.execute("SHOW server_version_num")
+        if int(cr.fetchone()[0]) < MIN_POSTGRESQL_VERSION:
+            raise orm.except_orm(
+                    'Error',
+                    'The jobs of the connectors require PostgreSQL 9.5 '
+                    'or a later version.')
+        # the payloads were text pickles before the serializers, keep
+        # them as bytes, the serializers are still able to read them
+        cr.execute("SELECT column_name FROM information_schema.columns "
+                   "WHERE table_name = 'jobs_storage' "
+                   "AND column_name IN ('func', 'result') "
+                   "AND data_type = 'text'")
+        for column, in cr.fetchall():
+            cr.execute("ALTER TABLE jobs_storage ALTER COLUMN %s "
+                       "TYPE bytea USING convert_to(%s, 'UTF8')" %
+                       (column, column))
+        res = super(JobsStorageModel, self)._auto_init(cr, context=context)
+        # jobs enqueued before the latest start dates
+        latest_start, params = JobsQueue.instance.policy.sql_latest_start(
+                'jobs_storage')
+        cr.execute("UPDATE jobs_storage SET latest_start = " + latest_start +
+                   " WHERE latest_start IS NULL AND state IN %s",
+                   params + [(WAITING, QUEUED)])
+        # index used to dequeue the jobs in the order of the
+        # `AgingPolicy`, replacing the one on the priority
+        cr.execute("DROP INDEX IF EXISTS jobs_storage_queued_index")
+        self._create_index(cr, 'jobs_storage_latest_start_index',
+                           "(latest_start, id) WHERE state = 'queued'")
+        # index used to count the queued jobs of the congested channels
+        self._create_index(cr, 'jobs_storage_queued_channel_index',
+                           "(channel) WHERE state = 'queued'")
+        # index used to count the running jobs of the channels and to
+        # find the jobs of the stopped workers
+        self._create_index(cr, 'jobs_storage_started_index',
+                           "(channel) WHERE state = 'started'")
+        # index used by `vacuum`
+        self._create_index(cr, 'jobs_storage_done_index',
+                           "(date_done) WHERE state = 'done'")
+        # the done jobs are moved in this table by `vacuum`, with
+        # their traceback and result compressed
+        cr.execute("CREATE TABLE IF NOT EXISTS jobs_storage_archive ("
+                   " id integer PRIMARY KEY,"
+                   " uuid varchar,"
+                   " name varchar,"
+                   " func_string varchar,"
+                   " channel varchar,"
+                   " user_id integer,"
+                   " date_created timestamp,"
+                   " date_done timestamp,"
+                   " exc_info bytea,"
+                   " result bytea)")
+        self._create_index(cr, 'jobs_storage_archive_uuid_index',
+                           "(uuid)", table='jobs_storage_archive')
+        # a job is waiting until its parents are done
+        cr.execute("CREATE TABLE IF NOT EXISTS jobs_storage_dependency ("
+                   " job_uuid varchar NOT NULL,"
+                   " parent_uuid varchar NOT NULL)")
+        self._create_index(cr, 'jobs_storage_dependency_job_index',
+                           "(job_uuid)", table='jobs_storage_dependency')
+        self._create_index(cr, 'jobs_storage_dependency_parent_index',
+                           "(parent_uuid)", table='jobs_storage_dependency')
+        # jobs enqueued by transactions, to put in the memory queue
+        # once committed
+        cr.execute("CREATE TABLE IF NOT EXISTS jobs_storage_outbox ("
+                   " id serial PRIMARY KEY,"
+                   " job_id integer NOT NULL)")
+        # last and next runs of the periodic tasks
+        cr.execute("CREATE TABLE IF NOT EXISTS jobs_storage_schedule ("
+                   " name varchar PRIMARY KEY,"
+                   " last_run timestamp,"
+                   " next_run timestamp,"
+                   " last_job_uuid varchar)")
+        return res
+
+    def _create_index(self, cr, name, definition, table='jobs_storage'):
+        cr.execute("SELECT indexname FROM pg_indexes WHERE indexname = %s",
+                   (name,))
+        if not cr.fetchone():
+            cr.execute("CREATE INDEX %s ON %s %s" % (name, table, definition))
+
+    def vacuum(self, cr, uid, days=DEFAULT_RETENTION_DAYS, archive=True,
+               batch_size=VACUUM_BATCH_SIZE, context=None):
+        """ Remove the jobs done for more than `days` days
+
+        Called by a scheduled action whose arguments are the
+        arguments of this method.
+
+        The jobs are removed by batches, each batch is committed.
+        The active jobs stay in ``jobs_storage``, which keeps it small.
+
+        :param days: number of days the done jobs are kept
+        :param archive: if True, the removed jobs are copied in the table
+                        ``jobs_storage_archive`` with their traceback and
+                        result compressed, without their arguments
+        :param batch_size: number of jobs removed per transaction
+        """
+        limit = datetime.now() - timedelta(days=days)
+        limit = limit.strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        total = 0
+        while True:
+            cr.execute("SELECT id, uuid, name, func_string, channel, "
+                       "       user_id, date_created, date_done, "
+                       "       exc_info, result "
+                       "FROM jobs_storage "
+                       "WHERE state = %s AND date_done < %s "
+                       "ORDER BY id LIMIT %s "
+                       "FOR UPDATE SKIP LOCKED",
+                       (DONE, limit, batch_size))
+            rows = cr.fetchall()
+            if not rows:
+                break
+            if archive:
+                values = []
+                for row in rows:
+                    exc_info, result = row[-2:]
+                    if exc_info:
+                        exc_info = Binary(zlib.compress(
+                            ustr(exc_info).encode('utf-8')))
+                    if result:
+                        result = Binary(zlib.compress(str(result)))
+                    values.append(tuple(row[:-2]) + (exc_info, result))
+                cr.execute("INSERT INTO jobs_storage_archive "
+                           "(id, uuid, name, func_string, channel, user_id, "
+                           " date_created, date_done, exc_info, result) "
+                           "VALUES %s" % ', '.join(['%s'] * len(values)),
+                           values)
+            cr.execute("DELETE FROM jobs_storage_dependency "
+                       "WHERE job_uuid IN %s",
+                       (tuple(row[1] for row in rows),))
+            cr.execute("DELETE FROM jobs_storage WHERE id IN %s",
+                       (tuple(row[0] for row in rows),))
+            cr.commit()
+            total += len(rows)
+        _logger.info('%d done jobs removed from the jobs storage', total)
+        return True
+
+    def read_archived(self, cr, uid, uuid, context=None):
+        """ Read an archived job, with its traceback and result
+        decompressed, returns None if the job is not archived """
+        cr.execute("SELECT uuid, name, func_string, channel, user_id, "
+                   "       date_created, date_done, exc_info, result "
+                   "FROM jobs_storage_archive WHERE uuid = %s", (uuid,))
+        row = cr.dictfetchone()
+        if row is None:
+            return None
+        if row['exc_info']:
+            row['exc_info'] = zlib.decompress(
+                    str(row['exc_info'])).decode('utf-8')
+        if row['result']:
+            row['result'] = SERIALIZERS.loads(
+                    zlib.decompress(str(row['result'])))
+        return row
+
+    def _queue_depth(self, cr):
+        """ Number of waiting, queued and started jobs per channel and
+        priority """
+        cr.execute("SELECT state, channel, priority, count(*) "
+                   "FROM jobs_storage "
+                   "WHERE state IN %s "
+                   "GROUP BY state, channel, priority "
+                   "ORDER BY state, channel, priority",
+                   ((WAITING, QUEUED, STARTED),))
+        return [({'state': state, 'channel': channel,
+                  'priority': priority}, count)
+                for state, channel, priority, count in cr.fetchall()]
+
+    def get_metrics(self, cr, uid, context=None):
+        """ Return the metrics of the jobs
+
+        The depth of the queue is read in the database, the other
+        metrics (enqueued jobs, wait before the start, duration of the
+        execution, done / failed / retried jobs per task) are collected
+        by the current process since its start.
+        """
+        metrics = METRICS.snapshot()
+        metrics['gauges'] = {'connectors_queue_depth': self._queue_depth(cr)}
+        return metrics
+
+    def metrics_text(self, cr, uid, context=None):
+        """ Return the metrics of the jobs in the plain-text format
+        of Prometheus """
+        gauges = {'connectors_queue_depth': self._queue_depth(cr)}
+        return METRICS.export_text(gauges=gauges)
+
     def requeue(self, cr, uid, ids, context=None):
         if isinstance(ids, (int, long)):
             ids = [ids]
@@ -61,6 +276,8 @@ class JobsStorageModel(orm.Model):
         for dbjob in self.browse(cr, uid, ids, context=context):
             if dbjob.state == 'failed':
                 job = Job(job_id=dbjob.uuid)
+                job.storage_id = dbjob.id
                 job.refresh(session)
+                job.retry = 0
                 JobsQueue.instance.enqueue_job(session, job)
         return True
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Author: Guewen Baconnier
+#    Copyright 2012 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Metrics of the jobs
+
+Counters and histograms collected in the process by the queues and the
+workers, for instance::
+
+    METRICS.increment('connectors_jobs_total', task='a.b', state='done')
+    METRICS.observe('connectors_job_run_seconds', 1.2, task='a.b')
+
+They can be exported in the plain-text format of Prometheus with
+`Metrics.export_text`.
+
+"""
+
+import threading
+
+# upper bounds of the buckets of the histograms, in seconds
+DEFAULT_BUCKETS = (0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+
+class Histogram(object):
+    """ Distribution of observed values in cumulative buckets """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        return {'buckets': zip(self.buckets, self.counts),
+                'count': self.count,
+                'sum': self.sum}
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.iteritems()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, unicode(value).replace('"', '\\"'))
+                             for key, value in labels)
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}  # name: {labels: value}
+        self.histograms = {}  # name: {labels: Histogram}
+
+    def increment(self, name, value=1, **labels):
+        with self._lock:
+            values = self.counters.setdefault(name, {})
+            key = _labels_key(labels)
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        with self._lock:
+            histograms = self.histograms.setdefault(name, {})
+            key = _labels_key(labels)
+            if key not in histograms:
+                histograms[key] = Histogram(buckets)
+            histograms[key].observe(value)
+
+    def snapshot(self):
+        """ Return the counters and histograms as a dict """
+        with self._lock:
+            counters = dict(
+                (name, [(dict(labels), value)
+                        for labels, value in values.iteritems()])
+                for name, values in self.counters.iteritems())
+            histograms = dict(
+                (name, [(dict(labels), histogram.snapshot())
+                        for labels, histogram in values.iteritems()])
+                for name, values in self.histograms.iteritems())
+        return {'counters': counters, 'histograms': histograms}
+
+    def export_text(self, gauges=None):
+        """ Export the metrics in the plain-text format of Prometheus
+
+        :param gauges: optional dict ``{name: [(labels, value)]}`` of
+                       values measured at the time of the export, with
+                       ``labels`` a dict
+        """
+        lines = []
+        for name, values in sorted((gauges or {}).iteritems()):
+            lines.append('# TYPE %s gauge' % name)
+            for labels, value in values:
+                lines.append('%s%s %s' % (name,
+                                          _format_labels(_labels_key(labels)),
+                                          value))
+        with self._lock:
+            for name, values in sorted(self.counters.iteritems()):
+                lines.append('# TYPE %s counter' % name)
+                for labels, value in sorted(values.iteritems()):
+                    lines.append('%s%s %s' % (name, _format_labels(labels),
+                                              value))
+            for name, values in sorted(self.histograms.iteritems()):
+                lines.append('# TYPE %s histogram' % name)
+                for labels, histogram in sorted(values.iteritems()):
+                    for bound, count in zip(histogram.buckets,
+                                            histogram.counts):
+                        bucket_labels = labels + (('le', bound),)
+                        lines.append('%s_bucket%s %s' %
+                                     (name, _format_labels(bucket_labels),
+                                      count))
+                    lines.append('%s_bucket%s %s' %
+                                 (name,
+                                  _format_labels(labels + (('le', '+Inf'),)),
+                                  histogram.count))
+                    lines.append('%s_sum%s %s' % (name, _format_labels(labels),
+                                                  histogram.sum))
+                    lines.append('%s_count%s %s' %
+                                 (name, _format_labels(labels),
+                                  histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
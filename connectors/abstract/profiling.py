@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Author: Guewen Baconnier
+#    Copyright 2012 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Profiling of the jobs
+
+The execution of a job can be profiled with cProfile, the most
+expensive functions and the number of SQL queries are then stored on
+the job.
+
+The profiling is enabled for a task with ``@task(profile=True)`` or
+with options of the server configuration file::
+
+    [options]
+    # names of the tasks to profile
+    connectors_profile_tasks = openerp.addons.connectors.implementation.tasks.import_generic
+    # channels whose jobs are profiled
+    connectors_profile_channels = referential.1
+    # ratio of the other jobs profiled, between 0 and 1
+    connectors_profile_rate = 0.01
+
+"""
+
+import cProfile
+import pstats
+import random
+from StringIO import StringIO
+
+import openerp
+
+DEFAULT_TOP = 30  # number of functions kept in the summary
+
+
+def _config_list(name):
+    value = openerp.tools.config.get(name) or ''
+    return set(item.strip() for item in value.split(',') if item.strip())
+
+
+class ProfilingPolicy(object):
+    """ Decide which jobs are profiled
+
+    :param tasks: names of the tasks always profiled
+    :param channels: names of the channels always profiled
+    :param rate: probability to profile any other job
+    """
+
+    def __init__(self, tasks=None, channels=None, rate=0.):
+        self.tasks = set(tasks or ())
+        self.channels = set(channels or ())
+        self.rate = rate
+
+    def should_profile(self, job):
+        task = job.task
+        if task is not None and task.profile:
+            return True
+        if job.func_name in self.tasks or job.channel in self.channels:
+            return True
+        return self.rate > 0 and random.random() < self.rate
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            tasks=_config_list('connectors_profile_tasks'),
+            channels=_config_list('connectors_profile_channels'),
+            rate=float(openerp.tools.config.get('connectors_profile_rate')
+                       or 0))
+
+
+class Profiler(object):
+    """ Profile the code executed between `start` and `stop`
+
+    The SQL queries are counted on the cursor `cr` (the queries of the
+    other cursors opened meanwhile are not counted).
+    """
+
+    def __init__(self, cr, top=DEFAULT_TOP):
+        self.cr = cr
+        self.top = top
+        self.profile = cProfile.Profile()
+        self._start_count = None
+        self.stats = None
+        self.query_count = None
+
+    def _sql_count(self):
+        return getattr(self.cr, 'sql_log_count', None)
+
+    def start(self):
+        self._start_count = self._sql_count()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        end_count = self._sql_count()
+        if self._start_count is not None and end_count is not None:
+            self.query_count = end_count - self._start_count
+        buff = StringIO()
+        stats = pstats.Stats(self.profile, stream=buff)
+        stats.sort_stats('cumulative').print_stats(self.top)
+        self.stats = buff.getvalue()
+
+
+PROFILING = ProfilingPolicy.from_config()
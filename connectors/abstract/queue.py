@@ -20,54 +20,966 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 ##############################################################################
+import heapq
 import logging
-from Queue import PriorityQueue
-from datetime import datetime
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from itertools import count
 
+import openerp
+from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
 from .session import Session
-from .jobs import Job, QUEUED, DONE, FAILED
+from .jobs import (Job, TASKS, QUEUED, STARTED, DONE, FAILED, WAITING,
+                   RELAY_BATCH_SIZE)
+from .channels import CHANNELS, DEFAULT_CHANNEL
+from .metrics import METRICS
 
 _logger = logging.getLogger(__name__)
 
+DEFAULT_AGING = 60  # seconds of waiting for a job to gain 1 priority level
+# channel of the notifications sent when jobs are enqueued, the
+# notifications are scoped to the database
+NOTIFY_CHANNEL = 'connectors_jobs'
+# seconds between 2 relays of the outbox when the notifications are
+# received, they are only a fallback for the lost notifications
+RELAY_FALLBACK_INTERVAL = 30
+# maximum seconds a producer waits for a congested channel
+DEFAULT_BACKPRESSURE_TIMEOUT = 5
+BACKLOG_CHECK_INTERVAL = 1  # seconds between 2 counts of a channel backlog
+
+
+class AgingPolicy(object):
+    """ Order the jobs by an effective priority improving with the time
+    they wait, so the jobs with a low priority are not starved
+
+    The effective priority of a job is ``priority - waited / aging``:
+    a job gains one priority level each ``aging`` seconds. As all the
+    jobs age at the same speed, ordering by the effective priority is
+    ordering by ``date_enqueued + priority * aging``, the latest date a
+    job should start. It does not change over time so it can be used
+    to sort the heaps, and it is stored in the ``latest_start`` column
+    of the jobs to sort them in the database with an index.
+
+    :param aging: seconds to wait to gain one priority level
+    :param max_latency: dict ``{priority: seconds}`` bounding the time
+                        the jobs of a priority should wait, replacing
+                        ``priority * aging`` for these priorities
+    """
+
+    def __init__(self, aging=DEFAULT_AGING, max_latency=None):
+        self.aging = aging
+        self.max_latency = max_latency or {}
+
+    def latency(self, priority):
+        """ Seconds a job of a priority should wait at most """
+        if priority in self.max_latency:
+            return self.max_latency[priority]
+        return priority * self.aging
+
+    def latest_start(self, job):
+        """ Latest date a job should start, stored with the job """
+        enqueued = job.date_enqueued or job.date_created
+        if job.only_after and job.only_after > enqueued:
+            enqueued = job.only_after
+        return enqueued + timedelta(seconds=self.latency(job.priority))
+
+    def sort_key(self, job):
+        """ Timestamp of the latest date a job should start """
+        return time.mktime(self.latest_start(job).timetuple())
+
+    def sql_latest_start(self, alias, date_enqueued=None):
+        """ SQL expression and its parameters computing `latest_start`
+        for the rows of a table
+
+        :param alias: name or alias of the ``jobs_storage`` table
+        :param date_enqueued: enqueue date replacing the one of the rows
+        """
+        latency = "%s.priority * %%s" % alias
+        params = [self.aging]
+        if self.max_latency:
+            cases = []
+            for priority, seconds in sorted(self.max_latency.iteritems()):
+                cases.append("WHEN %s.priority = %%s THEN %%s" % alias)
+                params += [priority, seconds]
+            latency = "CASE %s ELSE %s END" % (' '.join(cases), latency)
+            params = params[1:] + params[:1]
+        enqueued = "%s.date_enqueued" % alias
+        if date_enqueued is not None:
+            enqueued = "%s::timestamp"
+            params.insert(0, date_enqueued)
+        return ("GREATEST(%(enqueued)s, %(a)s.only_after) + "
+                "(%(latency)s) * interval '1 second'" %
+                {'a': alias, 'enqueued': enqueued, 'latency': latency},
+                params)
+
+    @classmethod
+    def from_config(cls):
+        """ Policy configured by the ``connectors_priority_aging``
+        (seconds) and ``connectors_max_latency`` (comma separated
+        ``priority:seconds``) options of the server configuration """
+        config = openerp.tools.config
+        aging = float(config.get('connectors_priority_aging') or
+                       DEFAULT_AGING)
+        max_latency = {}
+        for item in (config.get('connectors_max_latency') or '').split(','):
+            if item.strip():
+                priority, seconds = item.split(':')
+                max_latency[int(priority)] = float(seconds)
+        return cls(aging=aging, max_latency=max_latency)
+
+
+class QueueEntry(object):
+    """ Compact entry of a job in a queue
+
+    Only the identifiers of the job are kept in memory, the job is
+    read from the storage when it is executed.
+    """
+
+    __slots__ = ('uuid', 'storage_id', 'channel', 'func_name')
+
+    def __init__(self, uuid, storage_id, channel, func_name=None):
+        self.uuid = uuid
+        self.storage_id = storage_id
+        self.channel = channel
+        self.func_name = func_name
+
+    def __repr__(self):
+        return '<QueueEntry %s>' % self.uuid
+
 
 class JobsQueue(object):
-    """ Implementation """
+    """ Implementation
+
+    The jobs ready to be executed are kept in a priority heap per
+    channel, ordered by the `AgingPolicy`, then in the order they have
+    been enqueued. The channels are served in turn, skipping the ones
+    which have reached their capacity or their rate limit.
+    The jobs with an ``only_after`` date in the future are kept aside
+    in a heap sorted by date and moved to the ready ones when they are
+    due. A worker waiting for a job sleeps until the next due date,
+    until a job is enqueued or until a channel accepts a new job.
+
+    The heaps contain compact `QueueEntry`, the dequeued jobs have to
+    be read from the storage before their execution.
+
+    When a channel reaches its high watermark, its new jobs are only
+    kept in the storage (deferred) until the channel goes below its low
+    watermark, the workers then load them with `refill`.
+
+    Enqueuing a job does not commit the transaction of the caller: the
+    job is stored with a row in an outbox table and the workers put the
+    jobs of the committed transactions in memory with `relay_outbox`.
+    The jobs of a rolled back transaction are never executed.
+
+    The enqueuing transactions send a ``NOTIFY`` delivered on commit to
+    all the processes, their listeners call `wakeup` so the waiting
+    workers relay the new jobs at once.
+
+    The producers of a channel whose queued jobs in the storage reach
+    its high watermark wait until they go below its low watermark, at
+    most `backpressure_timeout` seconds (``connectors_backpressure_timeout``
+    option, 0 to never wait), then the job is enqueued anyway.
+    """
 
     job_cls = Job
     instance = None
+    # the pending jobs of the storage have to be put in the queue
+    # when the workers start
+    load_on_start = True
+    # state of the jobs returned by `dequeue`
+    dequeued_state = QUEUED
+    # the enqueued jobs go through the outbox
+    use_outbox = True
 
-    def __init__(self):
-        self._queue = PriorityQueue()
+    def __init__(self, policy=None):
+        if policy is None:
+            policy = AgingPolicy.from_config()
+        self.policy = policy
+        # channel name: heap of (sort key, sequence, entry) ready to run
+        self._ready = {}
+        self._rotation = deque()  # channels having ready jobs, in turn
+        # heap of (only_after, sequence, sort key, entry)
+        self._delayed = []
+        self._sequence = count()
+        self._condition = threading.Condition()
+        self._depth = {}  # channel name: number of entries in memory
+        # channel name: number of jobs deferred since its last refill
+        self._deferred = {}
+        self._refilling = set()
+        self._relay_lock = threading.Lock()
+        # set by the listener of the notifications
+        self.listening = False
+        self._wakeups = 0
+        self._relay_needed = True
+        self._last_relay = 0
+        self.backpressure_timeout = float(
+                openerp.tools.config.get('connectors_backpressure_timeout') or
+                DEFAULT_BACKPRESSURE_TIMEOUT)
+        # channel name: (time of the count, True if congested)
+        self._congestion = {}
+
+    def for_database(self, db_name):
+        """ Return the queue the workers of a database dequeue from """
+        return self
 
     def enqueue_resolve_args(self, session, func, *args, **kwargs):
         """Create a Job and enqueue it in the queue"""
         priority = kwargs.pop('priority', None)
         only_after = kwargs.pop('only_after', None)
+        max_retries = kwargs.pop('max_retries', None)
+        depends_on = kwargs.pop('depends_on', None)
 
         return self.enqueue(session, func, args=args,
                             kwargs=kwargs, priority=priority,
-                            only_after=only_after)
+                            only_after=only_after,
+                            max_retries=max_retries,
+                            depends_on=depends_on)
 
     def enqueue_job(self, session, job):
-        job.state = QUEUED
+        """ Store and enqueue a job
+
+        A job depending on other jobs is stored as waiting, it is put
+        in the queue when they are all done.
+        """
+        job.state = WAITING if job.depends_on else QUEUED
         job.date_enqueued = datetime.now()
+        job.latest_start = self.policy.latest_start(job)
         job.user_id = session.uid
         job.store(session)
+        METRICS.increment('connectors_jobs_enqueued_total',
+                          task=job.func_name, channel=job.channel)
+
+        if job.state == WAITING:
+            # the parents may be done already
+            self.release_waiting(session, job.storage_cls, uuids=[job.id])
+            _logger.debug('%s waiting for %s', job, job.depends_on)
+        else:
+            self._admit(session, [job])
+            _logger.debug('%s enqueued', job)
+
+    def enqueue_jobs(self, session, jobs):
+        """ Store and enqueue many new jobs at once """
+        now = datetime.now()
+        for job in jobs:
+            job.state = WAITING if job.depends_on else QUEUED
+            job.date_enqueued = now
+            job.latest_start = self.policy.latest_start(job)
+            job.user_id = session.uid
+        by_storage = {}
+        for job in jobs:
+            by_storage.setdefault(job.storage_cls, []).append(job)
+        for storage_cls, storage_jobs in by_storage.iteritems():
+            storage_cls.store_many(session, storage_jobs)
+        for job in jobs:
+            METRICS.increment('connectors_jobs_enqueued_total',
+                              task=job.func_name, channel=job.channel)
+
+        self._admit(session, [job for job in jobs if job.state == QUEUED])
+        for storage_cls, storage_jobs in by_storage.iteritems():
+            waiting = [job.id for job in storage_jobs
+                       if job.state == WAITING]
+            if waiting:
+                self.release_waiting(session, storage_cls, uuids=waiting)
+        _logger.debug('%d jobs enqueued', len(jobs))
+
+    def release_waiting(self, session, storage_cls, parent=None, uuids=None):
+        """ Put in the queue the waiting jobs whose parents are done
+
+        Called when a job is done with its uuid as `parent`.
+        See `OpenERPJobStorage.release_waiting`.
+        """
+        jobs = storage_cls.release_waiting(session, self.job_cls,
+                                           parent=parent, uuids=uuids,
+                                           policy=self.policy)
+        if jobs:
+            self._admit(session, jobs)
+            _logger.debug('%d waiting jobs released', len(jobs))
+        return jobs
+
+    def requeue_orphans(self, session, storage_cls):
+        """ Put in the queue the started jobs whose worker is gone
+
+        See `OpenERPJobStorage.requeue_orphans`.
+        """
+        jobs = storage_cls.requeue_orphans(session, self.job_cls)
+        if jobs:
+            self._admit(session, jobs)
+            _logger.warning('%d jobs interrupted with their worker are '
+                            'queued again', len(jobs))
+        return jobs
+
+    def _admit(self, session, jobs):
+        """ Make the stored jobs available to the workers once the
+        transaction of the session is committed """
+        if not jobs:
+            return
+        if self.use_outbox:
+            by_storage = {}
+            for job in jobs:
+                by_storage.setdefault(job.storage_cls, []).append(job)
+            for storage_cls, storage_jobs in by_storage.iteritems():
+                storage_cls.add_to_outbox(session, storage_jobs)
+        # sent on commit, the duplicates of a transaction are merged
+        session.cr.execute("NOTIFY %s" % NOTIFY_CHANNEL)
+
+    def wakeup(self):
+        """ Wake up the waiting workers, called when jobs have been
+        enqueued, possibly by another process """
+        with self._condition:
+            self._wakeups += 1
+            self._relay_needed = True
+            self._condition.notify_all()
+
+    def relay_due(self):
+        """ Return True when the outbox has to be relayed: jobs have
+        been notified, or the notifications are not received, or for
+        the fallback relay """
+        with self._condition:
+            return (self._relay_needed or not self.listening or
+                    time.time() - self._last_relay >=
+                    RELAY_FALLBACK_INTERVAL)
+
+    def relay_outbox(self, session, storage_cls):
+        """ Put in memory the jobs enqueued by the committed
+        transactions, returns their number
+
+        Only one relay runs at a time, the other calls return at once.
+        """
+        if not self._relay_lock.acquire(False):
+            return 0
+        with self._condition:
+            self._relay_needed = False
+            self._last_relay = time.time()
+        try:
+            total = 0
+            # each batch is popped in its own transaction
+            session.commit()
+            while True:
+                jobs = storage_cls.pop_outbox(session, self.job_cls,
+                                              batch_size=RELAY_BATCH_SIZE)
+                # removed from the outbox before being in memory: at
+                # worst they are loaded on the next start
+                session.commit()
+                self._put(jobs)
+                total += len(jobs)
+                if len(jobs) < RELAY_BATCH_SIZE:
+                    break
+            return total
+        finally:
+            self._relay_lock.release()
+
+    def put_stored_jobs(self, jobs):
+        """ Put in the queue jobs already stored as queued """
+        self._put(jobs)
+
+    def _put(self, jobs):
+        """ Make stored jobs available to the workers """
+        with self._condition:
+            for job in jobs:
+                self._push(job)
+
+    def _push(self, job, admit=False):
+        """ Add a job in the ready or in the delayed jobs, the
+        condition must be acquired
+
+        The job is deferred when its channel is congested, unless
+        `admit` is True.
+        """
+        depth = self._depth.get(job.channel, 0)
+        if not admit and (
+                job.channel in self._deferred or
+                CHANNELS.get_channel(job.channel).is_congested(depth)):
+            self._deferred[job.channel] = (
+                    self._deferred.get(job.channel, 0) + 1)
+            METRICS.increment('connectors_jobs_deferred_total',
+                              channel=job.channel)
+            return
+        self._depth[job.channel] = depth + 1
+        entry = QueueEntry(job.id, job.storage_id, job.channel,
+                           job.func_name)
+        sort_key = self.policy.sort_key(job)
+        if job.only_after and job.only_after > datetime.now():
+            heapq.heappush(self._delayed, (job.only_after,
+                                           next(self._sequence),
+                                           sort_key,
+                                           entry))
+        else:
+            self._push_ready(sort_key, entry)
+        self._condition.notify()
+
+    def _push_ready(self, sort_key, entry):
+        heap = self._ready.setdefault(entry.channel, [])
+        if not heap:
+            self._rotation.append(entry.channel)
+        heapq.heappush(heap, (sort_key, next(self._sequence), entry))
+
+    def _promote_due_jobs(self):
+        """ Move the delayed jobs which are due to the ready jobs, the
+        condition must be acquired """
+        now = datetime.now()
+        while self._delayed and self._delayed[0][0] <= now:
+            __, __, sort_key, entry = heapq.heappop(self._delayed)
+            self._push_ready(sort_key, entry)
+
+    def _pop_ready(self):
+        """ Take the next ready job, the channels are taken in turn and
+        the ones at their limits are skipped, the condition must be
+        acquired
+
+        Returns the entry, or None and the number of seconds before a
+        channel limited by its rate accepts a job (None when the
+        channels wait for running jobs to be done).
+        """
+        now = time.time()
+        wait = None
+        for __ in xrange(len(self._rotation)):
+            name = self._rotation[0]
+            self._rotation.rotate(-1)
+            channel = CHANNELS.get_channel(name)
+            if channel.is_full():
+                continue
+            channel_wait = channel.wait_time(now)
+            if channel_wait:
+                wait = channel_wait if wait is None else min(wait,
+                                                             channel_wait)
+                continue
+            heap = self._ready[name]
+            __, __, entry = heapq.heappop(heap)
+            if not heap:
+                self._rotation.remove(name)
+            self._depth[name] -= 1
+            channel.job_started(now)
+            return entry, None
+        return None, wait
+
+    def channels_to_refill(self):
+        """ Return the channels having deferred jobs to load, they
+        are reserved for the caller, which must call `refill` """
+        with self._condition:
+            channels = [name for name in self._deferred
+                        if name not in self._refilling and
+                        CHANNELS.get_channel(name).can_admit(
+                            self._depth.get(name, 0))]
+            self._refilling.update(channels)
+        return channels
+
+    def refill(self, session, storage_cls, channel_name):
+        """ Load the deferred jobs of a channel from the storage
 
-        self._queue.put_nowait(job)
-        _logger.debug('%s enqueued', job)
+        The first queued jobs of the channel are read, up to its high
+        watermark, and the ones not yet in memory are admitted. The
+        channel stops deferring its new jobs once all its queued jobs
+        have been loaded.
+        """
+        try:
+            with self._condition:
+                generation = self._deferred.get(channel_name)
+                in_memory = set(
+                    entry.uuid for __, __, entry
+                    in self._ready.get(channel_name, ()))
+                in_memory.update(
+                    entry.uuid for __, __, __, entry in self._delayed
+                    if entry.channel == channel_name)
+            limit = CHANNELS.get_channel(channel_name).high_watermark
+            jobs = storage_cls.queued_jobs(session, self.job_cls,
+                                           channel_name, limit)
+            with self._condition:
+                for job in jobs:
+                    if job.id not in in_memory:
+                        self._push(job, admit=True)
+                if (limit is None or len(jobs) < limit) and \
+                        self._deferred.get(channel_name) == generation:
+                    del self._deferred[channel_name]
+            _logger.debug('%d jobs of channel %s loaded', len(jobs),
+                          channel_name)
+        finally:
+            with self._condition:
+                self._refilling.discard(channel_name)
+
+    def _materialize(self, entry):
+        """ Return the job of a queue entry, its data have to be read
+        from the storage """
+        job = self.job_cls(job_id=entry.uuid)
+        job.storage_id = entry.storage_id
+        job.channel = entry.channel
+        job.func_name = entry.func_name
+        return job
+
+    def _batch_size(self, job):
+        """ Number of jobs which can be executed with `job` in one
+        transaction, declared on its task """
+        task = TASKS.tasks.get(job.func_name)
+        if task is None or not task.batch_size:
+            return 1
+        return task.batch_size
+
+    def dequeue_batch(self, job):
+        """ Take the ready jobs following a dequeued job which can be
+        executed in the same transaction: the jobs of the same task and
+        channel, as many as allowed by the task and the channel
+
+        Does not wait, returns a list, empty when no job can be added.
+        """
+        size = self._batch_size(job)
+        if size <= 1:
+            return []
+        jobs = []
+        now = time.time()
+        channel = CHANNELS.get_channel(job.channel)
+        with self._condition:
+            heap = self._ready.get(job.channel)
+            while (heap and len(jobs) < size - 1 and
+                    heap[0][2].func_name == job.func_name and
+                    channel.available(now)):
+                __, __, entry = heapq.heappop(heap)
+                self._depth[job.channel] -= 1
+                channel.job_started(now)
+                jobs.append(self._materialize(entry))
+            if not heap and job.channel in self._rotation:
+                self._rotation.remove(job.channel)
+        return jobs
+
+    def close(self):
+        """ Release the resources of the queue of a database, called
+        when its workers are stopped """
+
+    def job_done(self, job):
+        """ Called by the workers when the execution of a job they
+        dequeued is over """
+        with self._condition:
+            CHANNELS.get_channel(job.channel).job_done()
+            self._condition.notify()
+
+    def _is_congested(self, session, storage_cls, channel):
+        """ Return True while the queued jobs of a channel are above
+        its low watermark after having reached its high watermark
+
+        The count is done at most once per `BACKLOG_CHECK_INTERVAL`.
+        """
+        now = time.time()
+        checked, congested = self._congestion.get(channel.name, (0, False))
+        if now - checked < BACKLOG_CHECK_INTERVAL:
+            return congested
+        backlog = storage_cls.count_queued(session, channel.name,
+                                           channel.high_watermark)
+        if congested:
+            congested = not channel.can_admit(backlog)
+        else:
+            congested = channel.is_congested(backlog)
+        self._congestion[channel.name] = (now, congested)
+        return congested
+
+    def _wait_for_channels(self, session, storage_cls, channel_names):
+        """ Make the producer wait while the channels are congested,
+        at most `backpressure_timeout` seconds """
+        if not self.backpressure_timeout:
+            return
+        deadline = time.time() + self.backpressure_timeout
+        for name in set(channel_names):
+            channel = CHANNELS.get_channel(name)
+            if channel.high_watermark is None:
+                continue
+            if not self._is_congested(session, storage_cls, channel):
+                continue
+            METRICS.increment('connectors_producers_throttled_total',
+                              channel=name)
+            while self._is_congested(session, storage_cls, channel):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    _logger.warning('channel %s is congested, jobs are '
+                                    'enqueued without waiting more', name)
+                    return
+                time.sleep(min(BACKLOG_CHECK_INTERVAL, remaining))
 
     def enqueue(self, session, func, args=None, kwargs=None,
-                priority=None, only_after=None):
+                priority=None, only_after=None, max_retries=None,
+                depends_on=None):
+        """ Create and enqueue a job, returns its uuid
+
+        Waits when the channel of the job is congested.
+
+        :param depends_on: uuids of the jobs which must be done before
+                           the execution of this job
+        """
         job = self.job_cls(func=func, args=args, kwargs=kwargs,
-                           priority=priority, only_after=only_after)
+                           priority=priority, only_after=only_after,
+                           max_retries=max_retries, depends_on=depends_on)
+        if job.coalesce(session):
+            _logger.debug('%s merged in a queued job', job)
+            return job.id
+        self._wait_for_channels(session, job.storage_cls, [job.channel])
         self.enqueue_job(session, job)
+        return job.id
 
-    def dequeue(self):
-        """ Take the first job from the queue and return it """
-        job = self._queue.get()
+    def enqueue_many(self, session, func, calls, priority=None,
+                     only_after=None, max_retries=None, depends_on=None):
+        """ Create and enqueue many jobs for the same function
+
+        The jobs are stored with one INSERT, in the transaction of the
+        session. The jobs having the same coalesce key are merged
+        together, then in the queued job having this key, as with
+        `enqueue`.
+
+        :param calls: list of ``(args, kwargs)`` for each job, where
+                      ``args`` is a tuple and ``kwargs`` a dict
+        :param depends_on: uuids of the jobs which must be done before
+                           the execution of these jobs
+        :return: the created jobs, one per call, a merged job has the
+                 uuid of the job it has been merged in
+        """
+        jobs = [self.job_cls(func=func, args=args, kwargs=kwargs,
+                             priority=priority, only_after=only_after,
+                             max_retries=max_retries, depends_on=depends_on)
+                for args, kwargs in calls]
+        merged = self._coalesce_many(session, jobs)
+        new_jobs = [job for job in jobs if job not in merged]
+        if new_jobs:
+            self._wait_for_channels(session, new_jobs[0].storage_cls,
+                                    [job.channel for job in new_jobs])
+            self.enqueue_jobs(session, new_jobs)
+        for job, into in merged.iteritems():
+            job._id = into.id
+            job.storage_id = into.storage_id
+        return jobs
+
+    def _coalesce_many(self, session, jobs):
+        """ Merge the new jobs having the same coalesce key in the first
+        of them, which is merged in turn in the queued job having this
+        key if any
+
+        Returns a dict of the jobs not to store, with the job they have
+        been merged in.
+        """
+        groups = {}
+        for job in jobs:
+            if job.coalesce_key is not None and not job.depends_on:
+                groups.setdefault(job.coalesce_key, []).append(job)
+        merged = {}
+        for group in groups.itervalues():
+            first = group[0]
+            merge = first.task.coalesce
+            if merge is None:
+                merge = lambda pending, new: pending
+            for job in group[1:]:
+                first.kwargs = merge(first.kwargs, job.kwargs)
+                merged[job] = first
+            if first.coalesce(session):
+                _logger.debug('%s merged in a queued job', first)
+                merged[first] = first
+        return merged
+
+    def dequeue(self, timeout=None):
+        """ Take the first job from the queue and return it
+
+        :param timeout: if a number of seconds is given, wait at most
+                        this time for a job and return None when
+                        nothing has been fetched in time
+        """
+        if timeout is not None:
+            end = time.time() + timeout
+        with self._condition:
+            wakeups = self._wakeups
+            while True:
+                self._promote_due_jobs()
+                entry, wait = self._pop_ready()
+                if entry is not None:
+                    break
+                if self._wakeups != wakeups:
+                    # new jobs are notified, they have to be relayed
+                    return None
+                if self._delayed:
+                    next_due = self._delayed[0][0] - datetime.now()
+                    next_due = max(next_due.total_seconds(), 0)
+                    wait = next_due if wait is None else min(wait, next_due)
+                if timeout is not None:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._condition.wait(wait)
+        job = self._materialize(entry)
         _logger.debug('Fetched job %s', job)
         return job
 
 
-JobsQueue.instance = JobsQueue()
+class DatabaseJobsQueue(JobsQueue):
+    """ Queue using the jobs storage as queue
+
+    The jobs are not kept in memory, they are dequeued straight from
+    the ``jobs_storage`` table. The dequeued jobs are locked with
+    ``FOR UPDATE SKIP LOCKED`` and set as started in the same
+    transaction, so any number of processes, even on different nodes,
+    can share the work without taking the same job twice.
+
+    The jobs are taken in the order of their ``latest_start`` column,
+    computed by the `AgingPolicy` when they are enqueued, with an index
+    serving this order. The capacity of the channels is shared by all
+    the processes, the rate limits are applied per process.
+
+    It is used when the ``connectors_queue`` option of the server
+    configuration file is ``database``. It requires PostgreSQL 9.5.
+    The number of jobs claimed at once by a process is configured by
+    the ``connectors_fetch_size`` option (1 by default).
+
+    The enqueuing does not need a database name, it uses the session's
+    cursor, but the dequeuing does: the workers use the queue returned
+    by `for_database`.
+
+    The waiting workers look for jobs every `poll_interval` seconds and
+    as soon as a job is notified. The jobs are claimed one claim at a
+    time per process, on a cursor kept open by the queue.
+
+    A claimed job records the PID of the database backend which took
+    it, the workers of any process put it back in the queue once this
+    backend is gone (see `requeue_orphans`).
+    """
+
+    load_on_start = False
+    dequeued_state = STARTED  # set by `_claim_jobs`
+    use_outbox = False  # the committed jobs are visible in the storage
+    poll_interval = 1  # seconds between 2 lookups when no job is queued
+
+    def __init__(self, db_name=None, fetch_size=1, policy=None):
+        super(DatabaseJobsQueue, self).__init__(policy=policy)
+        self.db_name = db_name
+        self.fetch_size = fetch_size
+        self._fetched = deque()
+        self._fetch_lock = threading.Lock()
+        self._cr = None  # cursor claiming the jobs
+        self._wakeup_event = threading.Event()
+
+    def for_database(self, db_name):
+        return self.__class__(db_name, fetch_size=self.fetch_size,
+                              policy=self.policy)
+
+    def _put(self, jobs):
+        """ The jobs are dequeued from the storage """
+
+    def relay_outbox(self, session, storage_cls):
+        """ The jobs are dequeued from the storage """
+        return 0
+
+    def wakeup(self):
+        self._wakeup_event.set()
+
+    def job_done(self, job):
+        """ The running jobs are counted in the storage, a place is
+        free in the channel of the job """
+        self.wakeup()
+
+    def _cursor(self):
+        """ Cursor of the queue used to claim the jobs, kept open
+        between the claims, the `_fetch_lock` must be acquired
+
+        The cursor is in READ COMMITTED: in REPEATABLE READ, a row
+        claimed and committed by another process after the snapshot
+        is not skipped by ``SKIP LOCKED`` but raises a serialization
+        error.
+        """
+        if self._cr is None:
+            db = openerp.sql_db.db_connect(self.db_name)
+            self._cr = db.cursor(serialized=False)
+        return self._cr
+
+    def _close_cursor(self, discard=False):
+        """ Close the cursor of the queue
+
+        :param discard: close its connection too, instead of giving it
+                        back to the pool, its backend is then gone and
+                        the jobs it has claimed are orphans
+        """
+        cr, self._cr = self._cr, None
+        if cr is None:
+            return
+        if discard:
+            # the pool removes the closed connections
+            try:
+                cr._cnx.close()
+            except Exception:
+                pass
+        try:
+            cr.close()
+        except Exception:
+            # already closed with its connection
+            pass
+
+    def close(self):
+        """ Queue again the jobs fetched in advance which have not been
+        dequeued, then close the cursor """
+        with self._fetch_lock:
+            discard = False
+            if self._fetched and self._cr is not None:
+                try:
+                    self._cr.execute(
+                        "UPDATE jobs_storage "
+                        "SET state = %s, worker_pid = NULL "
+                        "WHERE uuid IN %s AND state = %s "
+                        "AND worker_pid = pg_backend_pid()",
+                        (QUEUED, tuple(job.id for job in self._fetched),
+                         STARTED))
+                    self._cr.commit()
+                except Exception:
+                    _logger.exception('Could not queue again the jobs '
+                                      'fetched in advance')
+                    discard = True
+            self._fetched.clear()
+            self._close_cursor(discard=discard)
+
+    def _claim_jobs(self, limit=None, channel=None, func_name=None):
+        """ Take the first queued jobs in the storage and set them as
+        started, the rows locked by another transaction are skipped
+
+        The `_fetch_lock` must be acquired. When the claim fails, the
+        cursor is closed with its connection and the jobs fetched in
+        advance are dropped: they are queued again as the backend which
+        claimed them is gone (see `requeue_orphans`).
+
+        :param limit: maximum number of jobs, by default `fetch_size`
+        :param channel: take only the jobs of this channel
+        :param func_name: take only the jobs of this task
+        """
+        if limit is None:
+            limit = self.fetch_size
+        now = datetime.now().strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        cr = self._cursor()
+        try:
+            rows, timestamp = self._select_jobs(cr, now, limit,
+                                                channel, func_name)
+            uuids = [row[1] for row in rows]
+            if uuids:
+                cr.execute("UPDATE jobs_storage "
+                           "SET state = %s, date_started = %s, "
+                           "    worker_pid = pg_backend_pid() "
+                           "WHERE uuid IN %s",
+                           (STARTED, now, tuple(uuids)))
+            cr.commit()
+        except Exception:
+            self._fetched.clear()
+            self._close_cursor(discard=True)
+            raise
+        jobs = []
+        for storage_id, uuid, channel_name, job_func_name in rows:
+            CHANNELS.get_channel(channel_name).take_token(timestamp)
+            job = self.job_cls(job_id=uuid)
+            job.storage_id = storage_id
+            job.channel = channel_name
+            job.func_name = job_func_name
+            jobs.append(job)
+        return jobs
+
+    def _select_jobs(self, cr, now, limit, channel, func_name):
+        """ Lock the queued jobs to claim, within the limits of their
+        channels, returns the rows and the time of the selection
+
+        No more jobs of a channel are claimed than its free capacity
+        and its tokens allow. The rows of the channels at their limit
+        are dropped after the selection, they are unlocked by the
+        commit of the claim.
+        """
+        cr.execute("SELECT COALESCE(channel, %s), count(*) "
+                   "FROM jobs_storage WHERE state = %s "
+                   "GROUP BY 1", (DEFAULT_CHANNEL, STARTED))
+        running = dict(cr.fetchall())
+        timestamp = time.time()
+        quotas = dict((name, limits.quota(running.get(name, 0), timestamp))
+                      for name, limits in CHANNELS.channels.iteritems())
+        where = ""
+        where_params = ()
+        if channel is not None:
+            quota = CHANNELS.get_channel(channel).quota(
+                    running.get(channel, 0), timestamp)
+            if quota is not None:
+                limit = min(limit, quota)
+            where += "AND COALESCE(j.channel, %s) = %s "
+            where_params += (DEFAULT_CHANNEL, channel)
+        else:
+            excluded = tuple(name for name, quota in quotas.iteritems()
+                             if quota == 0)
+            if excluded:
+                where += "AND COALESCE(j.channel, %s) NOT IN %s "
+                where_params += (DEFAULT_CHANNEL, excluded)
+        if func_name is not None:
+            where += "AND j.func_name = %s "
+            where_params += (func_name,)
+        if limit <= 0:
+            return [], timestamp
+        cr.execute("SELECT j.id, j.uuid, COALESCE(j.channel, %s), "
+                   "       j.func_name "
+                   "FROM jobs_storage j "
+                   "WHERE j.state = %s "
+                   "AND (j.only_after IS NULL OR j.only_after <= %s) " +
+                   where +
+                   "ORDER BY j.latest_start, j.id "
+                   "LIMIT %s "
+                   "FOR UPDATE SKIP LOCKED",
+                   (DEFAULT_CHANNEL, QUEUED, now) +
+                   where_params +
+                   (limit,))
+        rows = []
+        for row in cr.fetchall():
+            quota = quotas.get(row[2])
+            if quota is not None:
+                if quota <= 0:
+                    continue
+                quotas[row[2]] = quota - 1
+            rows.append(row)
+        return rows, timestamp
+
+    def dequeue_batch(self, job):
+        """ Claim the queued jobs which can be executed in the same
+        transaction as `job` """
+        size = self._batch_size(job)
+        if size <= 1:
+            return []
+        with self._fetch_lock:
+            try:
+                return self._claim_jobs(limit=size - 1, channel=job.channel,
+                                        func_name=job.func_name)
+            except Exception:
+                # the dequeued job is executed alone
+                _logger.exception('Could not claim the jobs of a batch')
+                return []
+
+    def _fetch(self):
+        with self._fetch_lock:
+            if not self._fetched:
+                try:
+                    self._fetched.extend(self._claim_jobs())
+                except Exception:
+                    _logger.exception('Could not claim jobs')
+                    return None
+            if self._fetched:
+                return self._fetched.popleft()
+        return None
+
+    def dequeue(self, timeout=None):
+        """ Take the first job from the storage and return it
+
+        :param timeout: if a number of seconds is given, wait at most
+                        this time for a job and return None when
+                        nothing has been fetched in time
+        """
+        assert self.db_name, "the queue is not bound to a database"
+        start = time.time()
+        while True:
+            job = self._fetch()
+            if job is not None:
+                _logger.debug('Fetched job %s', job)
+                return job
+            wait = self.poll_interval
+            if timeout is not None:
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    return None
+                wait = min(wait, remaining)
+            self._wakeup_event.wait(wait)
+            self._wakeup_event.clear()
+
+
+if openerp.tools.config.get('connectors_queue') == 'database':
+    JobsQueue.instance = DatabaseJobsQueue(fetch_size=int(
+        openerp.tools.config.get('connectors_fetch_size') or 1))
+else:
+    JobsQueue.instance = JobsQueue()
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Author: Guewen Baconnier
+#    Copyright 2012 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Periodic tasks
+
+A function decorated by ``@periodic_task`` is enqueued in a job at
+regular times by the `Scheduler` of the workers, for instance::
+
+    @periodic_task(interval=120)
+    def import_new_orders(session):
+        # work
+
+    @periodic_task(cron='0 3 * * *')
+    def import_catalog(session):
+        # work
+
+A run is skipped when the job of the previous run is still pending.
+The date of the next run is kept in the table ``jobs_storage_schedule``,
+shared by all the processes, and it is always computed from the time of
+the last run, so the runs missed while the server was stopped are not
+executed in a burst.
+
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+import openerp
+from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
+
+from .jobs import WAITING, QUEUED, STARTED, _parse_datetime
+from .session import Session
+from .channels import CHANNELS
+
+_logger = logging.getLogger(__name__)
+
+SCHEDULER_INTERVAL = 10  # seconds between 2 checks of the periodic tasks
+# seconds between 2 loads of the limits of the channels from the database
+CHANNELS_LOAD_INTERVAL = 60
+
+
+class IntervalSchedule(object):
+    """ Run every `interval` seconds """
+
+    def __init__(self, interval):
+        assert interval > 0, "the interval must be positive"
+        self.interval = interval
+
+    def next_run(self, after):
+        return after + timedelta(seconds=self.interval)
+
+    def __repr__(self):
+        return '<IntervalSchedule %ss>' % self.interval
+
+
+class CronSchedule(object):
+    """ Run at the times matching a cron expression
+
+    The expression has 5 fields: minute, hour, day of month, month and
+    day of week (0 is sunday). Each field is ``*``, a number, a range
+    ``a-b``, a step ``*/n`` or ``a-b/n`` or a comma separated list of
+    them.
+    """
+
+    _ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('Invalid cron expression: %s' % expression)
+        (self.minutes, self.hours, self.days,
+         self.months, self.weekdays) = [
+            self._parse_field(field, low, high)
+            for field, (low, high) in zip(fields, self._ranges)]
+        # as cron, when both the day of month and the day of week are
+        # restricted, a day matching one of them is accepted
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse_field(field, low, high):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/')
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [int(value) for value in part.split('-')]
+            else:
+                start = end = int(part)
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError('Invalid cron field: %s' % field)
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _match_day(self, moment):
+        # cron counts the days of week from sunday
+        weekday = (moment.weekday() + 1) % 7
+        in_days = moment.day in self.days
+        in_weekdays = weekday in self.weekdays
+        if self._any_day:
+            return in_weekdays
+        if self._any_weekday:
+            return in_days
+        return in_days or in_weekdays
+
+    def next_run(self, after):
+        moment = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # a matching time exists within 5 years (29th of february)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                if moment.month == 12:
+                    moment = moment.replace(year=moment.year + 1, month=1,
+                                            day=1, hour=0, minute=0)
+                else:
+                    moment = moment.replace(month=moment.month + 1, day=1,
+                                            hour=0, minute=0)
+            elif not self._match_day(moment):
+                moment = (moment + timedelta(days=1)).replace(hour=0,
+                                                              minute=0)
+            elif moment.hour not in self.hours:
+                moment = (moment + timedelta(hours=1)).replace(minute=0)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError('The cron expression %s never matches' %
+                         self.expression)
+
+    def __repr__(self):
+        return '<CronSchedule %s>' % self.expression
+
+
+class PeriodicTask(object):
+    """ A task enqueued according to a schedule
+
+    :param func: the function of the task, receiving only the session
+    :param schedule: an `IntervalSchedule` or a `CronSchedule`
+    """
+
+    def __init__(self, func, schedule):
+        self.func = func
+        self.name = '%s.%s' % (func.__module__, func.__name__)
+        self.schedule = schedule
+
+    def __repr__(self):
+        return '<PeriodicTask %s %r>' % (self.name, self.schedule)
+
+
+class PeriodicTaskRegistry(object):
+    """ Registry of the periodic tasks, filled by ``@periodic_task`` """
+
+    def __init__(self):
+        self.tasks = {}
+
+    def register(self, periodic_task):
+        self.tasks[periodic_task.name] = periodic_task
+
+
+PERIODIC_TASKS = PeriodicTaskRegistry()
+
+
+class Scheduler(threading.Thread):
+    """ Enqueue the jobs of the periodic tasks of a database when they
+    are due
+
+    The row of a periodic task in ``jobs_storage_schedule`` is locked
+    while it is checked, so the schedulers of several processes never
+    enqueue the same run twice.
+
+    The scheduler also loads periodically the limits of the channels
+    stored in the database, so a change made in a process is applied
+    by the workers of all the processes.
+    """
+
+    def __init__(self, db_name, queue, interval=SCHEDULER_INTERVAL,
+                 channels_interval=CHANNELS_LOAD_INTERVAL):
+        super(Scheduler, self).__init__(
+                name='connectors.scheduler.%s' % db_name)
+        self.daemon = True
+        self.db_name = db_name
+        self.queue = queue
+        self.interval = interval
+        self.channels_interval = channels_interval
+        self._last_channels_load = time.time()
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            registry = openerp.pooler.get_pool(self.db_name)
+            if (not registry.ready or
+                    'connectors.installed' not in registry.models):
+                continue
+            if time.time() - self._last_channels_load >= \
+                    self.channels_interval:
+                self._last_channels_load = time.time()
+                try:
+                    self.load_channels(registry)
+                except Exception:
+                    _logger.exception('Could not load the channels')
+            for periodic_task in PERIODIC_TASKS.tasks.values():
+                try:
+                    self.check(registry, periodic_task)
+                except Exception:
+                    _logger.exception('Could not schedule %s', periodic_task)
+
+    def load_channels(self, registry):
+        """ Apply the limits of the channels stored in the database """
+        db = openerp.sql_db.db_connect(self.db_name)
+        with Session(db.cursor(), openerp.SUPERUSER_ID, registry) as session:
+            CHANNELS.load(session)
+
+    def check(self, registry, periodic_task):
+        """ Enqueue the periodic task if its run is due
+
+        The transaction is in READ COMMITTED: a schedule row updated
+        by another process while this one waits for its lock is read
+        again instead of failing on a serialization error.
+        """
+        db = openerp.sql_db.db_connect(self.db_name)
+        cr = db.cursor(serialized=False)
+        with Session(cr, openerp.SUPERUSER_ID, registry) as session:
+            cr = session.cr
+            now = datetime.now()
+            cr.execute("INSERT INTO jobs_storage_schedule (name, next_run) "
+                       "VALUES (%s, %s) ON CONFLICT (name) DO NOTHING",
+                       (periodic_task.name,
+                        periodic_task.schedule.next_run(now).strftime(
+                            DEFAULT_SERVER_DATETIME_FORMAT)))
+            cr.execute("SELECT s.next_run, j.state "
+                       "FROM jobs_storage_schedule s "
+                       "LEFT JOIN jobs_storage j ON j.uuid = s.last_job_uuid "
+                       "WHERE s.name = %s "
+                       "FOR UPDATE OF s",
+                       (periodic_task.name,))
+            next_run, last_state = cr.fetchone()
+            next_run = _parse_datetime(next_run)
+            if next_run > now:
+                return
+            next_run = periodic_task.schedule.next_run(now)
+            if last_state in (WAITING, QUEUED, STARTED):
+                _logger.info('%s skipped, its previous run is %s',
+                             periodic_task, last_state)
+                cr.execute("UPDATE jobs_storage_schedule SET next_run = %s "
+                           "WHERE name = %s",
+                           (next_run.strftime(DEFAULT_SERVER_DATETIME_FORMAT),
+                            periodic_task.name))
+                return
+            uuid = self.queue.enqueue(session, periodic_task.func)
+            cr.execute("UPDATE jobs_storage_schedule "
+                       "SET last_run = %s, next_run = %s, last_job_uuid = %s "
+                       "WHERE name = %s",
+                       (now.strftime(DEFAULT_SERVER_DATETIME_FORMAT),
+                        next_run.strftime(DEFAULT_SERVER_DATETIME_FORMAT),
+                        uuid, periodic_task.name))
+            _logger.debug('%s enqueued, next run at %s',
+                          periodic_task, next_run)
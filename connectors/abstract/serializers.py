@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Author: Guewen Baconnier
+#    Copyright 2012 Camptocamp SA
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as
+#    published by the Free Software Foundation, either version 3 of the
+#    License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""
+Serialization of the payloads of the jobs (function, arguments, result)
+
+A payload starts with one byte giving the version of the format used to
+encode the rest of the payload, so the format can change without
+breaking the jobs already stored.
+
+"""
+
+import cPickle
+
+
+class Serializer(object):
+    """ Encode and decode the values of a payload """
+
+    version = None  # number of the format, written in the first byte
+
+    def dumps(self, value):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+
+class PickleSerializer(Serializer):
+    """ Binary pickle using the highest protocol """
+
+    version = 1
+
+    def dumps(self, value):
+        return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return cPickle.loads(data)
+
+
+class SerializerRegistry(object):
+
+    def __init__(self):
+        self.serializers = {}
+        self.default = None
+
+    def register_serializer(self, serializer, default=False):
+        """ Register a serializer, the default one encodes the new
+        payloads """
+        assert 0 < serializer.version < 32, "version must be a control byte"
+        self.serializers[serializer.version] = serializer
+        if default or self.default is None:
+            self.default = serializer
+
+    def dumps(self, value):
+        """ Return the payload for a value """
+        return chr(self.default.version) + self.default.dumps(value)
+
+    def loads(self, payload):
+        """ Return the value of a payload """
+        payload = str(payload)
+        serializer = self.serializers.get(ord(payload[0]))
+        if serializer is None:
+            # stored before the versioned payloads as a text
+            # pickle, which never starts with a control byte
+            return cPickle.loads(payload)
+        return serializer.loads(payload[1:])
+
+
+SERIALIZERS = SerializerRegistry()
+SERIALIZERS.register_serializer(PickleSerializer(), default=True)
+
+
+class LazyPayload(object):
+    """ A payload only decoded on the first access to its value """
+
+    __slots__ = ('payload', '_value', '_loaded')
+
+    def __init__(self, payload):
+        self.payload = payload
+        self._value = None
+        self._loaded = False
+
+    @property
+    def value(self):
+        if not self._loaded:
+            self._value = SERIALIZERS.loads(self.payload)
+            self._loaded = True
+        return self._value
@@ -19,17 +19,144 @@
 #
 ##############################################################################
 
-from functools import wraps
+from functools import wraps, partial
 
 from .queue import JobsQueue
+from .jobs import TASKS, Task
+from .scheduler import (PERIODIC_TASKS, PeriodicTask, IntervalSchedule,
+                        CronSchedule)
 
 
 # decorators
-def task(func):
+def task(func=None, priority=None, max_retries=None,
+         coalesce_key=None, coalesce=None, debounce=None, channel=None,
+         timeout=None, profile=False, batch_size=None):
+    """ Decorate a function to be able to delay its execution in a job
+
+    The function is registered in the tasks registry, the jobs find
+    their function there.
+
+    Can be used as ``@task`` or with options, as
+    ``@task(priority=20, max_retries=3)``.
+
+    :param priority: default priority of the jobs
+    :param max_retries: number of times a job is retried when it raises
+                        a `RetryableJobError` before being set as failed
+    :param coalesce_key: function returning a key for the arguments
+                         (as a dict) of a job, a new job is merged in
+                         the queued job having the same key
+    :param coalesce: function merging the arguments (as dicts) of the
+                     queued job and of the new job
+    :param debounce: delay in seconds before the execution of a new job
+    :param channel: name of the channel of the jobs, or function
+                    returning the name for the arguments (as a dict) of
+                    a job
+    :param timeout: number of seconds after which a running job is
+                    considered as hung, it is then retried or set as
+                    failed by the watchdog of the workers
+    :param profile: profile the execution of the jobs, the summary is
+                    stored on the jobs
+    :param batch_size: a worker executes up to this number of jobs of
+                       the task and of the same channel in one
+                       transaction, each job in a savepoint, useful for
+                       the jobs so small that the transaction costs more
+                       than their work. The function must not commit
+                       the session: a commit interrupts the batch and
+                       the job is set as failed
+
+    Example, a product modified many times exported only once::
+
+        def export_key(call_args):
+            return call_args['record_id']
+
+        @task(coalesce_key=export_key, debounce=60)
+        def export_product(session, record_id):
+            # work
+
+    ``delay`` returns the uuid of the job. A job can wait for other
+    jobs with the ``depends_on`` option, for instance to import the
+    customer and the products of a sale order in parallel, then the
+    sale order::
+
+        customer = import_record.delay(session, 'res.partner', 10)
+        products = [import_record.delay(session, 'product.product', ext_id)
+                    for ext_id in (4, 5)]
+        import_record.delay(session, 'sale.order', 300,
+                            depends_on=[customer] + products)
+
+    """
+    if func is None:
+        return partial(task, priority=priority, max_retries=max_retries,
+                       coalesce_key=coalesce_key, coalesce=coalesce,
+                       debounce=debounce, channel=channel,
+                       timeout=timeout, profile=profile,
+                       batch_size=batch_size)
+
+    TASKS.register_task(Task(func, priority=priority,
+                             max_retries=max_retries,
+                             coalesce_key=coalesce_key,
+                             coalesce=coalesce,
+                             debounce=debounce,
+                             channel=channel,
+                             timeout=timeout,
+                             profile=profile,
+                             batch_size=batch_size))
+
     def delay(session, *args, **kwargs):
-        JobsQueue.instance.enqueue_resolve_args(
+        """ Delay the execution of the function, returns the job uuid
+
+        The options ``priority``, ``only_after``, ``max_retries`` and
+        ``depends_on`` are popped from the keyword arguments.
+        """
+        return JobsQueue.instance.enqueue_resolve_args(
                 session, func, *args, **kwargs)
+
+    def delay_many(session, calls, **options):
+        """ Delay many executions of the function at once
+
+        :param calls: list of ``(args, kwargs)``
+        :param options: ``priority``, ``only_after``, ``max_retries``,
+                        ``depends_on``
+        """
+        return JobsQueue.instance.enqueue_many(
+                session, func, calls, **options)
+
     func.delay = delay
+    func.delay_many = delay_many
     return func
 
-# TODO periodic_task?
+
+def periodic_task(func=None, interval=None, cron=None, **options):
+    """ Decorate a function to enqueue a job for it at regular times
+
+    The function receives only the session. The jobs are enqueued by
+    the scheduler of the workers, a run is skipped when the job of the
+    previous run is still pending and the runs missed while the server
+    was stopped are not executed at the restart.
+
+    :param interval: number of seconds between 2 runs
+    :param cron: cron expression (minute, hour, day of month, month,
+                 day of week) of the runs, as ``'0 3 * * *'`` for
+                 every day at 3:00
+    :param options: options of `task`
+
+    Example::
+
+        @periodic_task(interval=300, channel='root.magento')
+        def import_sale_orders(session):
+            # work
+
+    """
+    if func is None:
+        return partial(periodic_task, interval=interval, cron=cron,
+                       **options)
+    if (interval is None) == (cron is None):
+        raise ValueError('periodic_task needs either an interval '
+                         'or a cron expression')
+    if cron is not None:
+        schedule = CronSchedule(cron)
+    else:
+        schedule = IntervalSchedule(interval)
+    task(func, **options)
+    PERIODIC_TASKS.register(PeriodicTask(func, schedule))
+    return func
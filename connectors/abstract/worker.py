@@ -20,87 +20,516 @@
 ##############################################################################
 
 from StringIO import StringIO
+import atexit
 import traceback
 import logging
+import select
+import sys
 import threading
 import time
+from contextlib import contextmanager
+from itertools import count
+
+from psycopg2.extensions import TransactionRollbackError
 
 import openerp
-from .jobs import Job, STARTED, DONE, FAILED
-from .queue import JobsQueue
+from .jobs import Job, OpenERPJobStorage, QUEUED, STARTED, DONE, FAILED
+from .queue import JobsQueue, NOTIFY_CHANNEL
 from .session import Session
+from .metrics import METRICS
+from .profiling import PROFILING, Profiler
+from .scheduler import Scheduler
 from .exceptions import (NoSuchJobError,
                          NotReadableJobError,
+                         NoSuchTaskError,
                          FailedJobError,
                          RetryableJobError)
 
 _logger = logging.getLogger(__name__)
 
 WAIT_REGISTRY_TIME = 1  # seconds
+WAIT_JOB_TIME = 1  # seconds, a stopped worker exits within this delay
+DEFAULT_WORKERS = 1  # number of workers per database
+WATCHDOG_INTERVAL = 10  # seconds between 2 checks of the hung jobs
+# seconds between 2 lookups of the jobs started by stopped workers
+ORPHAN_CHECK_INTERVAL = 60
+# seconds of inactivity after which the connection of a worker is
+# checked before being used again
+CURSOR_CHECK_INTERVAL = 60
+LISTEN_TIMEOUT = 1  # seconds, a stopped listener exits within this delay
+LISTEN_RETRY_DELAY = 10  # seconds before listening again after an error
+# seconds the server waits for each worker to finish its job on exit
+DEFAULT_SHUTDOWN_TIMEOUT = 30
+# tries to start the jobs modified concurrently
+START_ATTEMPTS = 3
+
+
+def _format_exc():
+    buff = StringIO()
+    traceback.print_exc(file=buff)
+    return buff.getvalue()
+
+
+class _AbandonedJob(Exception):
+    """ The watchdog has given up the job being executed """
 
 
 class Worker(threading.Thread):
 
-    def __init__(self, db_name, queue=JobsQueue.instance):
+    def __init__(self, db_name, queue=JobsQueue.instance, worker_pool=None):
         super(Worker, self).__init__()
         self.queue = queue
         self.db_name = db_name
         self.registry = openerp.pooler.get_pool(db_name)
+        self.worker_pool = worker_pool
         self.started = False
+        self._stopping = threading.Event()
+        # job being executed and its deadline, checked by the `Watchdog`
+        self._job_lock = threading.Lock()
+        self.current_job = None
+        self.current_batch = []
+        self.deadline = None
+        self.backend_pid = None
+        self.abandoned = False
+        self.abandoned_jobs = []
+        self.abandoned_pid = None
+        # cursor kept by the worker for all its jobs
+        self._cr = None
+        self._cr_pid = None  # PID of the database backend of the cursor
+        self._cr_used = 0
+        self._cr_suspect = False
+
+    def _cursor(self):
+        """ Return the cursor of the worker, a new one is opened when
+        the connection of the current one does not answer """
+        if self._cr is not None and not self._check_cursor():
+            _logger.warning('%s: connection lost, reconnecting', self.name)
+            self._close_cursor()
+        if self._cr is None:
+            db = openerp.sql_db.db_connect(self.db_name)
+            cr = db.cursor()
+            cr.execute("SELECT pg_backend_pid()")
+            self._cr_pid = cr.fetchone()[0]
+            cr.rollback()
+            self._cr = cr
+            self._cr_suspect = False
+        return self._cr
+
+    def _check_cursor(self):
+        """ Check the connection of the cursor, only after a failed
+        transaction or a period of inactivity """
+        if (not self._cr_suspect and
+                time.time() - self._cr_used < CURSOR_CHECK_INTERVAL):
+            return True
+        try:
+            self._cr.rollback()
+            self._cr.execute("SELECT 1")
+            self._cr.rollback()
+        except Exception:
+            return False
+        self._cr_suspect = False
+        return True
+
+    def _close_cursor(self):
+        cr, self._cr = self._cr, None
+        if cr is None:
+            return
+        if self.abandoned:
+            # the statements of the backend may have been cancelled by
+            # the watchdog, the connection must not be reused by the
+            # pool, it removes the closed connections
+            try:
+                cr._cnx.close()
+            except Exception:
+                pass
+        try:
+            cr.close()
+        except Exception:
+            # already closed with its connection
+            pass
+
+    @contextmanager
+    def _session(self):
+        """ Session on the cursor of the worker, committed at the end
+        or rolled back on error, the cursor is not closed """
+        session = Session(self._cursor(), openerp.SUPERUSER_ID,
+                          self.registry)
+        try:
+            yield session
+            session.commit()
+        except:
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            self._cr_suspect = True
+            try:
+                session.rollback()
+            except Exception:
+                _logger.debug('Could not rollback', exc_info=True)
+            raise exc_type, exc_value, exc_tb
+        finally:
+            self._cr_used = time.time()
+
+    def stop(self):
+        """ Ask the worker to exit once its current job is done """
+        self._stopping.set()
+
+    @property
+    def stopping(self):
+        return self._stopping.is_set()
 
     def run_job(self, job):
         """ """
-        db = openerp.sql_db.db_connect(self.db_name)
-        cr = db.cursor()
-
-        with Session(cr, openerp.SUPERUSER_ID, self.registry) as session:
+        with self._session() as session:
+            # the job is read once started: a queued job can still
+            # be modified when other jobs are merged in it
+            if not self._start_jobs(session, [job]):
+                _logger.debug('Already taken: %s', job)
+                return
             try:
                 try:
                     job.refresh(session)
                 except NoSuchJobError:
                     return
-                except NotReadableJobError:
+                except (NotReadableJobError, NoSuchTaskError):
                     # will be put in failed by the enclosing try/except
                     _logger.debug('Cannot read: %s', job)
                     raise
-                job.set_state(session, STARTED)
                 _logger.debug('Starting: %s', job)
-                result = job.perform(session)
+                result = self._perform(session, job)
                 _logger.debug('Done: %s', job)
-                job.set_state(session, DONE, result=result)
-            except RetryableJobError:
-                # TODO: implement the retryable errrors:
-                # retryable should be requeued with a only_after date
-                raise NotImplementedError('RetryableJobError to implement')
+                # committed with the work of the job
+                if not job.set_state(session, DONE, result=result,
+                                     commit=False):
+                    _logger.warning('%s is no longer started, its work is '
+                                    'rolled back', job)
+                    session.rollback()
+                    return
+                self._count(job, DONE)
+                self.queue.release_waiting(session, job.storage_cls,
+                                           parent=job.id)
+            except _AbandonedJob:
+                # the watchdog has given up the job and replaced this
+                # worker, the job is no longer ours
+                session.rollback()
+            except RetryableJobError as err:
+                if job.retry >= job.max_retries:
+                    self._set_failed(session, job)
+                    self._count(job, FAILED)
+                    raise
+                # enqueue again the job, it will be executed after
+                # a delay growing with the number of tries
+                exc_info = _format_exc()
+                session.rollback()
+                self._postpone(session, job, exc_info, err)
             except (FailedJobError, Exception):  # XXX Exception?
-                # TODO allow to pass a pipeline of exception
-                # handlers (log errors, send by email, ...)
-                buff = StringIO()
-                traceback.print_exc(file=buff)
-                _logger.error(buff.getvalue())
-                # the session cursor may be in an bad state
-                error_session = Session(
-                        db.cursor(), openerp.SUPERUSER_ID, self.registry)
-                with error_session:
-                    job.set_state(error_session, FAILED,
-                                  exc_info=buff.getvalue())
+                self._set_failed(session, job)
+                self._count(job, FAILED)
                 raise
 
+    def _start_jobs(self, session, jobs):
+        """ Set the dequeued jobs as started and commit
+
+        A serialization failure means that the jobs have been modified
+        by another transaction since the snapshot, when jobs have been
+        merged in them or when they have been started elsewhere: the
+        start is tried again on their new versions. The jobs which
+        still cannot be started are considered as taken.
+
+        Returns the jobs started by this worker.
+        """
+        by_storage = {}
+        for job in jobs:
+            by_storage.setdefault(job.storage_cls, []).append(job)
+        started = []
+        for storage_cls, storage_jobs in by_storage.iteritems():
+            for __ in range(START_ATTEMPTS):
+                try:
+                    started += storage_cls.start_many(
+                            session, storage_jobs,
+                            from_states=(self.queue.dequeued_state,))
+                    break
+                except TransactionRollbackError:
+                    session.rollback()
+            else:
+                _logger.debug('Could not start, considered as taken: %s',
+                              storage_jobs)
+        return started
+
+    def run_batch(self, jobs):
+        """ Execute many jobs in one transaction, committed once
+
+        Each job is executed in a savepoint, the failure of a job rolls
+        back only its own work. The jobs are set as started together
+        before their execution.
+
+        The tasks executed by batches must not commit: a commit ends
+        the transaction of the batch and its savepoints. The batch is
+        then interrupted, the job being executed is set as failed and
+        the jobs not done are queued again.
+        """
+        started = []
+        current = None
+        with self._job_lock:
+            self.current_batch = jobs
+        try:
+            with self._session() as session:
+                started += self._start_jobs(session, jobs)
+                for job in started:
+                    current = job
+                    try:
+                        self._run_in_savepoint(session, job)
+                    except _AbandonedJob:
+                        # the watchdog has given up the batch and queued
+                        # its other jobs again, they are no longer ours
+                        session.rollback()
+                        return
+                current = None
+        except Exception:
+            if not started or self.abandoned:
+                raise
+            self._recover_batch(started, current)
+        finally:
+            with self._job_lock:
+                self.current_batch = []
+
+    def _recover_batch(self, jobs, interrupted):
+        """ Clean up after the failure of the transaction of a batch,
+        the started jobs would stay started forever
+
+        :param jobs: the jobs of the batch
+        :param interrupted: the job being executed when the batch
+                            failed, set as failed, or None when the
+                            batch failed outside of a job
+        """
+        exc_info = _format_exc()
+        _logger.error('Batch of %d jobs interrupted while executing %s: %s',
+                      len(jobs), interrupted, exc_info)
+        with self._session() as session:
+            if interrupted is not None:
+                interrupted.set_state(session, FAILED, exc_info=exc_info,
+                                      from_states=(STARTED,))
+                self._count(interrupted, FAILED)
+            self._requeue(session, [job for job in jobs
+                                    if job is not interrupted])
+
+    def _run_in_savepoint(self, session, job):
+        """ Execute a job of a batch, the changes of states are
+        committed with the batch """
+        cr = session.cr
+        try:
+            job.refresh(session)
+        except NoSuchJobError:
+            return
+        except (NotReadableJobError, NoSuchTaskError):
+            _logger.debug('Cannot read: %s', job)
+            job.set_state(session, FAILED, exc_info=_format_exc(),
+                          commit=False)
+            self._count(job, FAILED)
+            return
+        _logger.debug('Starting: %s', job)
+        cr.execute("SAVEPOINT connectors_batch_job")
+        try:
+            result = self._perform(session, job)
+        except _AbandonedJob:
+            raise
+        except RetryableJobError as err:
+            exc_info = _format_exc()
+            cr.execute("ROLLBACK TO SAVEPOINT connectors_batch_job")
+            if job.retry >= job.max_retries:
+                _logger.error(exc_info)
+                job.set_state(session, FAILED, exc_info=exc_info,
+                              commit=False)
+                self._count(job, FAILED)
+            else:
+                self._postpone(session, job, exc_info, err)
+        except Exception:
+            exc_info = _format_exc()
+            _logger.error(exc_info)
+            cr.execute("ROLLBACK TO SAVEPOINT connectors_batch_job")
+            job.set_state(session, FAILED, exc_info=exc_info, commit=False)
+            self._count(job, FAILED)
+        else:
+            cr.execute("RELEASE SAVEPOINT connectors_batch_job")
+            _logger.debug('Done: %s', job)
+            job.set_state(session, DONE, result=result, commit=False)
+            self._count(job, DONE)
+            self.queue.release_waiting(session, job.storage_cls,
+                                       parent=job.id)
+
+    def _perform(self, session, job):
+        """ Execute a started job and return its result
+
+        Raises `_AbandonedJob` when the watchdog has given up the job
+        meanwhile.
+        """
+        if job.date_enqueued and job.date_started:
+            wait = job.date_started - job.date_enqueued
+            METRICS.observe('connectors_job_wait_seconds',
+                            max(wait.total_seconds(), 0),
+                            task=job.func_name, channel=job.channel)
+        profiler = None
+        if PROFILING.should_profile(job):
+            profiler = Profiler(session.cr)
+        start = time.time()
+        self._watch_job(job)
+        try:
+            if profiler is not None:
+                profiler.start()
+            return job.perform(session)
+        finally:
+            if profiler is not None:
+                profiler.stop()
+                job.profile_stats = profiler.stats
+                job.query_count = profiler.query_count
+            METRICS.observe('connectors_job_run_seconds',
+                            time.time() - start,
+                            task=job.func_name, channel=job.channel)
+            if not self._release_job():
+                raise _AbandonedJob()
+
+    def _postpone(self, session, job, exc_info, err):
+        """ Enqueue again a job, it will be executed after a delay
+        growing with the number of tries """
+        job.postpone()
+        job.exc_info = exc_info
+        with session.change_user(job.user_id):
+            self.queue.enqueue_job(session, job)
+        self._count(job, 'retried')
+        _logger.info('%s postponed to %s (try %d/%d): %s',
+                     job, job.only_after, job.retry,
+                     job.max_retries, err)
+
+    def _requeue(self, session, jobs):
+        """ Put back in the queue the jobs of a batch rolled back, only
+        the ones still started: the states of the jobs done may have
+        been committed by a job of the batch """
+        if not jobs:
+            return
+        session.cr.execute("UPDATE jobs_storage SET state = %s "
+                           "WHERE uuid IN %s AND state = %s "
+                           "RETURNING uuid",
+                           (QUEUED, tuple(job.id for job in jobs), STARTED))
+        requeued = set(uuid for uuid, in session.cr.fetchall())
+        session.commit()
+        self.queue.put_stored_jobs([job for job in jobs
+                                    if job.id in requeued])
+
+    def _watch_job(self, job):
+        """ Register the job being executed and its deadline """
+        timeout = job.timeout
+        if timeout is None and self.worker_pool is not None:
+            timeout = self.worker_pool.timeout
+        with self._job_lock:
+            self.current_job = job
+            self.backend_pid = self._cr_pid
+            self.deadline = time.time() + timeout if timeout else None
+
+    def _release_job(self):
+        """ Unregister the job being executed
+
+        Returns False if the job has been abandoned in the meantime.
+        """
+        with self._job_lock:
+            self.current_job = None
+            self.backend_pid = None
+            self.deadline = None
+            return not self.abandoned
+
+    def abandon_expired_job(self, now, cancel_backend):
+        """ Abandon the current job if its deadline is passed
+
+        The worker stops after the job. Returns the job, or None. The
+        jobs given up with it, the other jobs of its batch, are kept
+        in `abandoned_jobs` and the PID of its backend in
+        `abandoned_pid`.
+
+        :param cancel_backend: function receiving the PID of the
+                               database backend executing the job and
+                               ``terminate``, True when the transaction
+                               of a batch, locking its jobs, has to be
+                               ended; called before the job can return
+                               and release the backend
+        """
+        with self._job_lock:
+            if (self.current_job is None or self.deadline is None or
+                    self.deadline > now):
+                return None
+            self.abandoned = True
+            self.abandoned_jobs = (list(self.current_batch) or
+                                   [self.current_job])
+            self.abandoned_pid = self.backend_pid
+            self.stop()
+            if self.backend_pid is not None:
+                try:
+                    cancel_backend(self.backend_pid,
+                                   terminate=bool(self.current_batch))
+                except Exception:
+                    _logger.exception('Could not cancel the statement of '
+                                      '%s', self.current_job)
+            return self.current_job
+
+    def _count(self, job, outcome):
+        METRICS.increment('connectors_jobs_total', task=job.func_name,
+                          channel=job.channel, state=outcome)
+
+    def _set_failed(self, session, job):
+        """ Set the job started by the worker as failed with the current
+        traceback, the work of the job is rolled back """
+        # TODO allow to pass a pipeline of exception
+        # handlers (log errors, send by email, ...)
+        exc_info = _format_exc()
+        _logger.error(exc_info)
+        try:
+            session.rollback()
+            job.set_state(session, FAILED, exc_info=exc_info,
+                          from_states=(STARTED,))
+        except Exception:
+            # the connection of the session may be lost
+            self._close_cursor()
+            with self._session() as error_session:
+                job.set_state(error_session, FAILED, exc_info=exc_info,
+                              from_states=(STARTED,))
+
     def run(self):
         """ """
-        while True:
-            while (self.registry.ready and
+        try:
+            self._run()
+        finally:
+            self._close_cursor()
+
+    def _run(self):
+        while not self.stopping:
+            while (not self.stopping and
+                   self.registry.ready and
                    'connectors.installed' in self.registry.models):
-                if not self.started:
-                    # TODO: ensure that in multiprocess, the jobs are
-                    # loaded in one queue only
-                    self.on_start_put_in_queue()
-                    self.started = True
-                job = self.queue.dequeue()
+                if not self.started and self.queue.load_on_start:
+                    if self.worker_pool is not None:
+                        self.worker_pool.load_pending_jobs(self)
+                    else:
+                        self.on_start_put_in_queue()
+                elif not self.started:
+                    self.release_waiting_jobs()
+                self.started = True
+                if self.queue.use_outbox and self.queue.relay_due():
+                    self.relay_outbox()
+                self.refill_queue()
+                job = self.queue.dequeue(timeout=WAIT_JOB_TIME)
+                if job is None:
+                    continue
+                jobs = [job]
                 try:
-                    self.run_job(job)
+                    jobs += self.queue.dequeue_batch(job)
+                    if len(jobs) > 1:
+                        self.run_batch(jobs)
+                    else:
+                        self.run_job(job)
                 except:
                     continue
+                finally:
+                    for done_job in jobs:
+                        # the watchdog releases the abandoned jobs
+                        if not any(done_job is abandoned
+                                   for abandoned in self.abandoned_jobs):
+                            self.queue.job_done(done_job)
 
             _logger.debug('%s waiting for registry for %d seconds',
                           self,
@@ -112,29 +541,407 @@ class Worker(threading.Thread):
 
         Must be called when OpenERP starts.
 
-        Warning: if OpenERP has many processes with Gunicorn only 1 process must
-        take the jobs.
+        The jobs interrupted by the stop of the server are queued
+        again, only the ones whose worker is gone: the jobs being
+        executed by the other processes are kept. The queued jobs are
+        read by batches and each batch is put in the queue as soon as
+        it has been read, so the workers can already execute them.
+
+        When several processes load the same jobs, only one of them
+        can start a job (see `Job.set_state`).
         """
+        # runs in a loader thread, it cannot use the cursor of the worker
         db = openerp.sql_db.db_connect(self.db_name)
         cr = db.cursor()
         with Session(cr, openerp.SUPERUSER_ID, self.registry) as session:
-            cr.execute("SELECT uuid FROM jobs_storage "
-                       "WHERE state in ('queued', 'started') "
-                       "FOR UPDATE ")
-            uuids = cr.fetchall()
-            if uuids:
-                _logger.debug('Enqueue %d jobs on start of the worker.', len(uuids))
-                for uuid in [uuid for uuid, in uuids]:
-                    job = Job(job_id=uuid)
-                    job.refresh(session)
-                    JobsQueue.instance.enqueue_job(session, job)
+            OpenERPJobStorage.requeue_orphans(session, Job)
+            session.commit()
+            # the server may have stopped between the end of a job and
+            # the release of the jobs waiting for it
+            OpenERPJobStorage.release_waiting(session, Job,
+                                              policy=self.queue.policy)
+            # all the queued jobs are loaded below
+            cr.execute("DELETE FROM jobs_storage_outbox")
+            session.commit()
+            count = 0
+            for jobs in OpenERPJobStorage.pending_jobs(session, Job):
+                self.queue.put_stored_jobs(jobs)
+                count += len(jobs)
+                if self.stopping:
+                    break
+            _logger.debug('Enqueued %d jobs on start of the worker.', count)
+
+    def relay_outbox(self):
+        """ Put in the queue the jobs enqueued by the committed
+        transactions """
+        try:
+            with self._session() as session:
+                self.queue.relay_outbox(session, OpenERPJobStorage)
+        except Exception:
+            _logger.exception('Could not relay the enqueued jobs')
+
+    def refill_queue(self):
+        """ Load the deferred jobs of the channels which went below
+        their low watermark """
+        channels = self.queue.channels_to_refill()
+        if not channels:
+            return
+        for channel in channels:
+            try:
+                with self._session() as session:
+                    self.queue.refill(session, OpenERPJobStorage, channel)
+            except Exception:
+                _logger.exception('Could not load the deferred jobs '
+                                  'of channel %s', channel)
+
+    def release_waiting_jobs(self):
+        """ Release the waiting jobs whose parents have been done
+        before an interruption of the server """
+        with self._session() as session:
+            self.queue.release_waiting(session, OpenERPJobStorage)
+
+
+class WorkerPool(object):
+    """ Pool of `Worker` threads consuming the jobs of one database
+
+    All the workers of a pool take their jobs from the same queue, each
+    one of them opens its own cursor and `Session` for the jobs it runs.
+    The pending jobs are loaded in the queue only once per pool, by the
+    first worker finding the registry ready.
+
+    The pending jobs are loaded in a thread so the workers do not wait
+    the end of the loading to execute the first jobs.
+
+    The number of workers per database is configured with the
+    ``connectors_workers`` option of the server configuration file.
+
+    A `Watchdog` replaces the workers whose job runs for longer than
+    its timeout (declared on the task or by the ``connectors_job_timeout``
+    option). It also queues again the jobs left started by the workers
+    which are gone, in this process or in another one.
+
+    A `Listener` wakes up the workers when jobs are enqueued, unless
+    the ``connectors_listen`` option is false.
+
+    A `Scheduler` enqueues the jobs of the periodic tasks.
+    """
+
+    pools = {}  # database name: WorkerPool
+
+    def __init__(self, db_name, size=DEFAULT_WORKERS,
+                 queue=JobsQueue.instance, timeout=None, listen=True):
+        assert size > 0, "a pool needs at least 1 worker"
+        self.db_name = db_name
+        self.size = size
+        self.queue = queue
+        self.timeout = timeout
+        self.listen = listen
+        self.workers = []
+        self.loaded = False
+        self._load_lock = threading.Lock()
+        self._workers_lock = threading.Lock()
+        self._numbers = count()
+        self.watchdog = None
+        self.listener = None
+        self.scheduler = None
+
+    def load_pending_jobs(self, worker):
+        """ Called by the workers when they start, only the first call
+        assigns the pending jobs to the queue """
+        with self._load_lock:
+            if not self.loaded:
+                loader = threading.Thread(
+                        target=worker.on_start_put_in_queue,
+                        name='connectors.loader.%s' % self.db_name)
+                loader.daemon = True
+                loader.start()
+                self.loaded = True
+
+    def _start_worker(self):
+        worker = Worker(self.db_name, queue=self.queue, worker_pool=self)
+        worker.name = 'connectors.worker.%s.%d' % (self.db_name,
+                                                   next(self._numbers))
+        # an hung worker must not prevent the server to exit
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def start(self):
+        with self._workers_lock:
+            for __ in range(self.size):
+                self.workers.append(self._start_worker())
+        self.watchdog = Watchdog(self)
+        self.watchdog.start()
+        if self.listen:
+            self.listener = Listener(self.db_name, self.queue)
+            self.listener.start()
+        self.scheduler = Scheduler(self.db_name, self.queue)
+        self.scheduler.start()
+        _logger.debug('%d workers started for database %s',
+                      self.size, self.db_name)
+
+    def check_hung_jobs(self):
+        """ Give up the jobs running past their deadline
+
+        The statement of the hung job is cancelled, the job is retried
+        later or set as failed if it has no try left, and its worker is
+        replaced by a new one. The hung thread exits as soon as the job
+        returns, without touching the job.
+
+        When the job is part of a batch, the connection of the worker is
+        terminated instead, which rolls back the transaction of the
+        batch and releases its locks, and the other started jobs of the
+        batch are queued again.
+        """
+        now = time.time()
+        with self._workers_lock:
+            for index, worker in enumerate(self.workers):
+                job = worker.abandon_expired_job(now, self._cancel_backend)
+                if job is None:
+                    continue
+                self.workers[index] = self._start_worker()
+                _logger.error('%s did not finish in time, %s replaced by %s',
+                              job, worker.name, self.workers[index].name)
+                others = [other for other in worker.abandoned_jobs
+                          if other is not job]
+                try:
+                    self._give_up_job(job)
+                except Exception:
+                    _logger.exception('Could not give up %s', job)
+                try:
+                    if others:
+                        self._requeue_batch(others, worker.abandoned_pid)
+                except Exception:
+                    # queued again by `check_orphan_jobs` later
+                    _logger.exception('Could not queue again the batch '
+                                      'of %s', job)
+                finally:
+                    for abandoned in worker.abandoned_jobs:
+                        self.queue.job_done(abandoned)
+
+    def check_orphan_jobs(self):
+        """ Queue again the jobs started by the workers which are
+        gone, in any process, for instance after a crash """
+        registry = openerp.pooler.get_pool(self.db_name)
+        if (not registry.ready or
+                'connectors.installed' not in registry.models):
+            return
+        db = openerp.sql_db.db_connect(self.db_name)
+        # the started jobs are updated concurrently by the workers
+        cr = db.cursor(serialized=False)
+        with Session(cr, openerp.SUPERUSER_ID, registry) as session:
+            self.queue.requeue_orphans(session, OpenERPJobStorage)
+
+    def _cancel_backend(self, backend_pid, terminate=False):
+        """ Cancel the current statement of a database backend, or end
+        its connection and roll back its transaction if `terminate` """
+        db = openerp.sql_db.db_connect(self.db_name)
+        cr = db.cursor()
+        try:
+            if terminate:
+                cr.execute("SELECT pg_terminate_backend(%s)",
+                           (backend_pid,))
+            else:
+                cr.execute("SELECT pg_cancel_backend(%s)", (backend_pid,))
+        finally:
+            cr.close()
+
+    def _requeue_batch(self, jobs, backend_pid):
+        """ Queue again the jobs of an abandoned batch still started by
+        its database backend, their work has been rolled back with the
+        transaction of the batch """
+        db = openerp.sql_db.db_connect(self.db_name)
+        registry = openerp.pooler.get_pool(self.db_name)
+        with Session(db.cursor(serialized=False), openerp.SUPERUSER_ID,
+                     registry) as session:
+            session.cr.execute("UPDATE jobs_storage "
+                               "SET state = %s, worker_pid = NULL "
+                               "WHERE uuid IN %s AND state = %s "
+                               "AND worker_pid = %s "
+                               "RETURNING uuid",
+                               (QUEUED, tuple(job.id for job in jobs),
+                                STARTED, backend_pid))
+            requeued = set(uuid for uuid, in session.cr.fetchall())
+            session.commit()
+        self.queue.put_stored_jobs([job for job in jobs
+                                    if job.id in requeued])
+        _logger.warning('%d jobs of the batch of an abandoned job are '
+                        'queued again', len(requeued))
+
+    def _give_up_job(self, job):
+        db = openerp.sql_db.db_connect(self.db_name)
+        registry = openerp.pooler.get_pool(self.db_name)
+        with Session(db.cursor(), openerp.SUPERUSER_ID, registry) as session:
+            exc_info = ('Timeout: the job has been running for more than '
+                        'its time limit')
+            if job.retry < job.max_retries:
+                job.postpone()
+                job.exc_info = exc_info
+                with session.change_user(job.user_id):
+                    self.queue.enqueue_job(session, job)
+                METRICS.increment('connectors_jobs_total', task=job.func_name,
+                                  channel=job.channel, state='retried')
+            else:
+                job.set_state(session, FAILED, exc_info=exc_info,
+                              from_states=(STARTED,))
+                METRICS.increment('connectors_jobs_total', task=job.func_name,
+                                  channel=job.channel, state=FAILED)
+            METRICS.increment('connectors_jobs_timeout_total',
+                              task=job.func_name, channel=job.channel)
+
+    def stop(self, timeout=None):
+        """ Stop the workers and wait until they have finished their
+        current job
+
+        :param timeout: maximum number of seconds to wait for the workers
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        if self.listener is not None:
+            self.listener.stop()
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        with self._workers_lock:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            if deadline is None:
+                worker.join()
+            else:
+                worker.join(max(deadline - time.time(), 0))
+        self.queue.close()
+        _logger.debug('workers stopped for database %s', self.db_name)
+
+
+class Watchdog(threading.Thread):
+    """ Check periodically the jobs running in the workers of a pool
+    and give up the hung ones, and queue again the jobs of the workers
+    which are gone """
+
+    def __init__(self, worker_pool, interval=WATCHDOG_INTERVAL,
+                 orphan_interval=ORPHAN_CHECK_INTERVAL):
+        super(Watchdog, self).__init__(
+                name='connectors.watchdog.%s' % worker_pool.db_name)
+        self.daemon = True
+        self.worker_pool = worker_pool
+        self.interval = interval
+        self.orphan_interval = orphan_interval
+        self._last_orphan_check = 0
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.worker_pool.check_hung_jobs()
+            except Exception:
+                _logger.exception('Error in the watchdog of the workers')
+            if time.time() - self._last_orphan_check < self.orphan_interval:
+                continue
+            self._last_orphan_check = time.time()
+            try:
+                self.worker_pool.check_orphan_jobs()
+            except Exception:
+                _logger.exception('Could not queue again the jobs of the '
+                                  'stopped workers')
+
+
+class Listener(threading.Thread):
+    """ Listen to the notifications sent when jobs are enqueued in a
+    database, by any process, and wake up the workers of the queue
+
+    The notifications are received on a dedicated connection in
+    autocommit mode. The workers still look for jobs periodically in
+    case a notification is lost, for instance while the listener
+    reconnects.
+    """
+
+    def __init__(self, db_name, queue):
+        super(Listener, self).__init__(
+                name='connectors.listener.%s' % db_name)
+        self.daemon = True
+        self.db_name = db_name
+        self.queue = queue
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                self._listen()
+            except Exception:
+                _logger.exception('Error while listening to the jobs '
+                                  'notifications of %s', self.db_name)
+                self._stopping.wait(LISTEN_RETRY_DELAY)
+
+    def _listen(self):
+        db = openerp.sql_db.db_connect(self.db_name)
+        cr = db.cursor()
+        try:
+            cr.autocommit(True)
+            cr.execute("LISTEN %s" % NOTIFY_CHANNEL)
+            self.queue.listening = True
+            # jobs may have been enqueued before the listening
+            self.queue.wakeup()
+            connection = cr._cnx
+            while not self._stopping.is_set():
+                readable, __, __ = select.select([connection], [], [],
+                                                 LISTEN_TIMEOUT)
+                if not readable:
+                    continue
+                connection.poll()
+                if connection.notifies:
+                    del connection.notifies[:]
+                    self.queue.wakeup()
+        finally:
+            self.queue.listening = False
+            try:
+                # the connection goes back to the pool
+                cr.execute("UNLISTEN *")
+                cr.autocommit(False)
+            finally:
+                cr.close()
 
 
 def start_service():
+    size = int(openerp.tools.config.get('connectors_workers', DEFAULT_WORKERS))
+    # default timeout of the jobs in seconds, 0 for no timeout
+    timeout = int(openerp.tools.config.get('connectors_job_timeout', 0))
+    listen = openerp.tools.config.get('connectors_listen', True)
+    if isinstance(listen, basestring):
+        listen = listen.lower() not in ('0', 'false', 'no', 'off')
     registries = openerp.modules.registry.RegistryManager.registries
     for db_name, registry in registries.iteritems():
-        worker = Worker(db_name)
-        worker.daemon = True
-        worker.start()
+        if db_name in WorkerPool.pools:
+            continue
+        queue = JobsQueue.instance.for_database(db_name)
+        worker_pool = WorkerPool(db_name, size=size, queue=queue,
+                                 timeout=timeout or None, listen=listen)
+        WorkerPool.pools[db_name] = worker_pool
+        worker_pool.start()
+
+
+def stop_service(timeout=None):
+    """ Stop the workers of all the databases, waiting at most
+    `timeout` seconds per database for them to finish their current job
+
+    Called when the server exits: the workers are daemon threads which
+    would otherwise be killed in the middle of their job. The timeout
+    is configured with the ``connectors_shutdown_timeout`` option.
+    """
+    if timeout is None:
+        timeout = float(openerp.tools.config.get(
+                'connectors_shutdown_timeout') or DEFAULT_SHUTDOWN_TIMEOUT)
+    while WorkerPool.pools:
+        db_name, worker_pool = WorkerPool.pools.popitem()
+        worker_pool.stop(timeout=timeout)
 
 start_service()
+# the exit handlers run before the daemon threads are killed
+atexit.register(stop_service)
@@ -19,7 +19,27 @@
 #
 ##############################################################################
 
+from openerp import SUPERUSER_ID
 from openerp.osv import orm, fields
+from ..abstract.channels import CHANNELS, DEFAULT_CHANNEL
+
+
+def referential_channel(referential_id):
+    """ Name of the channel of the jobs of a referential """
+    if not referential_id:
+        return DEFAULT_CHANNEL
+    return 'referential.%d' % referential_id
+
+
+def _load_referential_channels(session):
+    """ Apply the limits of the referentials, they may have been
+    modified by another process """
+    referential_obj = session.pool.get('external.referential')
+    if referential_obj is not None:
+        referential_obj._configure_channels(session.cr,
+                                            context=session.context)
+
+CHANNELS.register_loader(_load_referential_channels)
 
 
 class external_referential_service(orm.Model):
@@ -57,8 +77,45 @@ class external_referential(orm.Model):
         'location': fields.char('Location'),
         'username': fields.char('Username'),
         'password': fields.char('Password'),
+        'job_capacity': fields.integer(
+            'Max. Running Jobs',
+            help="Maximum number of jobs of the referential running at "
+                 "the same time, 0 is unlimited."),
+        'job_rate_limit': fields.float(
+            'Max. Jobs per Second',
+            help="Maximum number of jobs of the referential started "
+                 "per second, 0 is unlimited."),
     }
 
+    def _configure_channels(self, cr, ids=None, context=None):
+        """ Apply the limits of the referentials on their channels """
+        if ids is None:
+            ids = self.search(cr, SUPERUSER_ID, [], context=context)
+        for referential in self.browse(cr, SUPERUSER_ID, ids,
+                                       context=context):
+            CHANNELS.configure_channel(
+                    referential_channel(referential.id),
+                    capacity=referential.job_capacity,
+                    rate_limit=referential.job_rate_limit)
+
+    def _register_hook(self, cr):
+        super(external_referential, self)._register_hook(cr)
+        self._configure_channels(cr)
+
+    def create(self, cr, uid, vals, context=None):
+        referential_id = super(external_referential, self).create(
+                cr, uid, vals, context=context)
+        self._configure_channels(cr, [referential_id], context=context)
+        return referential_id
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(external_referential, self).write(
+                cr, uid, ids, vals, context=context)
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        self._configure_channels(cr, ids, context=context)
+        return res
+
 
 class ir_model_data(orm.Model):
     _inherit = 'ir.model.data'
@@ -28,12 +28,17 @@ from ..abstract.session import Session
 from ..abstract.worker import Worker
 from ..abstract.queue import JobsQueue
 from .adapters import MagentoLocation
+from .external_referential import referential_channel
 from ..abstract import TO_REFERENCE, FROM_REFERENCE
 
 _logger = logging.getLogger(__name__)
 
 
-@task
+def _referential_channel(call_args):
+    return referential_channel(call_args.get('referential_id'))
+
+
+@task(channel=_referential_channel)
 def import_generic(session, model_name=None, record_id=None, mode='create',
                    referential_id=None, with_commit=False):
     """ Import a record from the external referential """
@@ -64,7 +69,27 @@ def import_generic(session, model_name=None, record_id=None, mode='create',
     importer.work(record_id, mode, with_commit=with_commit)
 
 
-@task
+def _export_coalesce_key(call_args):
+    return (call_args['model_name'],
+            call_args['record_id'],
+            call_args['referential_id'])
+
+
+def _export_coalesce(pending, new):
+    """ Export all the fields modified by the merged jobs """
+    merged = dict(pending)
+    if new['mode'] == 'create':
+        merged['mode'] = 'create'
+    if pending['fields'] is None or new['fields'] is None:
+        merged['fields'] = None
+    else:
+        merged['fields'] = sorted(set(pending['fields']) |
+                                  set(new['fields']))
+    return merged
+
+
+@task(coalesce_key=_export_coalesce_key, coalesce=_export_coalesce,
+      channel=_referential_channel)
 def export_generic(session, model_name=None, record_id=None,
                    mode='create', fields=None, referential_id=None,
                    with_commit=False):
@@ -135,6 +160,8 @@ class res_users(orm.Model):
         test1.delay(session, 'a', 1)
         test2.delay(session, 'a', 2, priority=2)
         test2.delay(session, 'b', 1)
+        # many jobs stored at once
+        test1.delay_many(session, [(('c', 1), {}), (('c', 2), {})])
         # direct, no job
         test2(session, 'b', 10)
         # work